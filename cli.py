@@ -2,14 +2,14 @@
 import argparse
 import os
 
-from src.compile import compile
-from src.llm import set_log_file
-from src.program import Program
-from src.run import run_program
+# Importing `src` loads `.env`. Everything else is imported where it's used, so
+# that submitting a job to a worker doesn't pay for pydantic, requests, etc.
+import src  # noqa: F401
 
 LOG_DIR = os.getenv("LOG_DIR", ".data/")
 
 def create_log_file(input_name: str, mode: str) -> str:
+    from src.llm import set_log_file
 
     if '.' in input_name and os.path.exists(input_name):
         # Remove extension and get base name
@@ -40,31 +40,189 @@ def parse_inline_script(script: str) -> list[str]:
     return [line.strip() for line in script.split(";") if line.strip()]
 
 
-def compile_mode(input_arg: str, is_script: bool, pretty: bool = False):
+def compile_mode(
+    input_arg: str,
+    is_script: bool,
+    pretty: bool = False,
+    daemon: bool = False,
+    socket_path: str | None = None,
+    parallel: bool = False,
+):
     """Compile a vibe program and print the AST."""
 
-    program = compile(handle_input(input_arg, is_script))
-    output = str(program) if pretty else program.model_dump_json(indent=2)
+    lines = handle_input(input_arg, is_script)
+    if daemon:
+        from src.server import submit
 
-    if pretty:
-        output = str(output)
-    return output
+        return submit(
+            {"mode": "compile", "lines": lines, "pretty": pretty, "parallel": parallel},
+            socket_path,
+        )
 
+    from src.artifact import dump_program, source_hash
+    from src.compile import compile
 
-def run_mode(input_arg: str, is_script: bool, compiled: bool = False):
+    program = compile(lines, parallel=parallel)
+    if pretty:
+        return str(program)
+    return dump_program(program, source_hash(lines))
+
+
+def run_mode(
+    input_arg: str,
+    is_script: bool,
+    compiled: bool = False,
+    daemon: bool = False,
+    socket_path: str | None = None,
+    run_options: dict | None = None,
+    parallel: bool = False,
+):
     """Run a vibe program and print the result."""
 
+    if daemon:
+        from src.server import submit
+
+        if compiled:
+            with open(input_arg) as f:
+                job = {"mode": "run", "compiled": f.read()}
+        else:
+            job = {
+                "mode": "run",
+                "lines": handle_input(input_arg, is_script),
+                "parallel": parallel,
+            }
+        job["options"] = run_options or {}
+        return submit(job, socket_path)
+
+    from src.artifact import load_program
+    from src.compile import compile
+    from src.llm import LLM
+    from src.run import RunOptions, run_program
+
+    llm = LLM.from_env()
     if compiled:
         with open(input_arg) as f:
-            json_content = f.read()
-        program = Program.model_validate_json(json_content)
+            program = load_program(f.read())
     else:
-        program = compile(handle_input(input_arg, is_script))
+        program = compile(handle_input(input_arg, is_script), llm, parallel)
 
-    result = run_program(program)
+    options = RunOptions.model_validate(run_options or {})
+    result = run_program(program, llm, options=options)
+    print(f"Telemetry: {llm.telemetry}")
+    llm.telemetry.save()
     return result
 
 
+def profile_mode(
+    input_arg: str,
+    is_script: bool,
+    compiled: bool = False,
+    run_options: dict | None = None,
+    parallel: bool = False,
+):
+    """Run a vibe program and report where the prompt tokens of each call come from."""
+    from src.artifact import load_program
+    from src.compile import compile
+    from src.llm import LLM
+    from src.profiler import start_profiling
+    from src.run import RunOptions, run_program
+
+    llm = LLM.from_env()
+    if compiled:
+        with open(input_arg) as f:
+            program = load_program(f.read())
+    else:
+        program = compile(handle_input(input_arg, is_script), llm, parallel)
+
+    # Only profile the run, not the compile
+    profiler = start_profiling()
+    options = RunOptions.model_validate(run_options or {})
+    run_program(program, llm, options=options)
+    print(f"Telemetry: {llm.telemetry}")
+    return profiler.report()
+
+
+def batch_mode(
+    input_arg: str,
+    params: str,
+    is_script: bool,
+    compiled: bool = False,
+    max_jobs: int = 4,
+    run_options: dict | None = None,
+    parallel: bool = False,
+):
+    """Run a vibe program once per row of a CSV file and return a CSV of results."""
+    import csv
+    import io
+
+    from src.artifact import load_program
+    from src.compile import compile
+    from src.jobs import run_jobs
+    from src.llm import LLM
+    from src.run import RunOptions
+
+    with open(params, newline="") as f:
+        reader = csv.DictReader(f)
+        columns = list(reader.fieldnames or [])
+        rows = list(reader)
+
+    llm = LLM.from_env()
+    if compiled:
+        with open(input_arg) as f:
+            program = load_program(f.read())
+    else:
+        program = compile(handle_input(input_arg, is_script), llm, parallel)
+
+    options = RunOptions.model_validate(run_options or {})
+    results = run_jobs(program, rows, llm, max_jobs, options)
+
+    output = io.StringIO()
+    writer = csv.DictWriter(output, fieldnames=columns + ["result", "error"])
+    writer.writeheader()
+    for result in results:
+        writer.writerow({**result.row, "result": result.output, "error": result.error})
+
+    failed = sum(1 for result in results if result.error)
+    print(f"Ran {len(results)} jobs, {failed} failed")
+    print(f"Telemetry: {llm.telemetry}")
+    llm.telemetry.save()
+    return output.getvalue()
+
+
+def estimate_mode(
+    input_arg: str, map_parallelism: int | None, max_items: int | None = None
+):
+    """Estimate the cost of running a compiled .vibec file, from previous runs."""
+    from src.artifact import load_program
+    from src.estimate import estimate_program, load_stats
+
+    with open(input_arg) as f:
+        program = load_program(f.read())
+
+    provider = os.getenv("LLM_PROVIDER", "")
+    model = os.getenv(f"{provider.upper()}_MODEL")
+    max_concurrency = int(os.getenv("LLM_MAX_CONCURRENCY", 8))
+    map_parallelism = map_parallelism or max_concurrency
+
+    stats = load_stats(model)
+    estimate = estimate_program(
+        program, stats, map_parallelism, max_concurrency, max_items
+    )
+    return (
+        f"Estimated from {stats.runs} previous runs, with parallelism "
+        f"{map_parallelism} and at most {max_concurrency} concurrent requests:\n"
+        f"{estimate}"
+    )
+
+
+def migrate_mode(input_arg: str):
+    """Rewrite a compiled .vibec file from an older format in the current one."""
+    from src.artifact import upgrade_artifact
+
+    with open(input_arg) as f:
+        return upgrade_artifact(f.read())
+
+
 def main():
     """Main CLI entry point."""
     parser = argparse.ArgumentParser(
@@ -75,26 +233,46 @@ Examples:
   python cli.py compile vibes/example.vibe -o vibes/examples.vibec
   python cli.py run vibes/example.vibe
   python cli.py run -c vibes/example.vibec
+  python cli.py migrate vibes/example.vibec -o vibes/example.vibec
+  python cli.py estimate vibes/nested_maps.vibec --parallelism 8
+  LLM_PROVIDER=mock python cli.py profile -c vibes/nested_maps.vibec
   python cli.py compile -s "for each item in list; process item; combine results"
   python cli.py run -s "for each item in list; process item; combine results"
+  python cli.py batch -c vibes/example.vibec --params rows.csv -o results.csv
+  python cli.py serve
+  python cli.py run -d vibes/example.vibe
         """,
     )
 
     parser.add_argument(
         "mode",
-        choices=["compile", "run"],
-        help="Mode: compile (show AST) or run (execute program)",
+        choices=["compile", "run", "batch", "estimate", "profile", "migrate", "serve"],
+        help="Mode: compile (show AST), run (execute program), batch (run once per row of --params), estimate (predict the cost of a .vibec file), profile (run and attribute prompt tokens to their sources), migrate (upgrade a .vibec file) or serve (start a worker)",
     )
 
     parser.add_argument(
-        "input", help="Either a path to a .vibe file or a semicolon-delimited script"
+        "input",
+        nargs="?",
+        help="Either a path to a .vibe file or a semicolon-delimited script",
     )
 
     parser.add_argument(
         "-c",
         "--compiled",
         action="store_true",
-        help="Run mode only: treat input as a compiled .vibec file (JSON format)",
+        help="Run, batch and profile modes only: treat input as a compiled .vibec file (JSON format)",
+    )
+
+    parser.add_argument(
+        "--params",
+        help="Batch mode only: CSV file with one row of parameters per run. Prompts can refer to columns as {column}",
+    )
+
+    parser.add_argument(
+        "-j", "--jobs",
+        type=int,
+        default=4,
+        help="Batch mode only: number of runs to execute concurrently (default 4)",
     )
 
     parser.add_argument(
@@ -103,42 +281,205 @@ Examples:
         help='Interpret "input" as a script instead of a filename'
     )
 
+    parser.add_argument(
+        "--parallel-compile",
+        action="store_true",
+        help="Compile top-level blocks of the vibe concurrently instead of line by line (vibes without indented blocks, e.g. -s scripts, still compile line by line)",
+    )
+
+    parser.add_argument(
+        "--parallelism",
+        type=int,
+        help="Run, batch, profile and estimate modes only: maximum branches of each map run concurrently (default $LLM_MAX_CONCURRENCY, leaving the adaptive limit to bound requests)",
+    )
+
+    parser.add_argument(
+        "--branch-retries",
+        type=int,
+        default=0,
+        help="Run, batch and profile modes only: times to retry a failed map branch (default 0)",
+    )
+
+    parser.add_argument(
+        "--fallback-model",
+        help="Run, batch and profile modes only: model for one last attempt at a failed map branch",
+    )
+
+    parser.add_argument(
+        "--continue-on-error",
+        action="store_true",
+        help="Run, batch and profile modes only: record failed map branches in the results instead of failing the run",
+    )
+
+    parser.add_argument(
+        "--no-local",
+        action="store_true",
+        help="Run, batch and profile modes only: always use the LLM, even for commands compiled to a local operation",
+    )
+
+    parser.add_argument(
+        "--max-items",
+        type=int,
+        help="Run, batch, profile and estimate modes only: maximum items of a fold, or of a map without its own limit",
+    )
+
+    parser.add_argument(
+        "--overflow",
+        choices=["fail", "truncate", "random", "stratified"],
+        default="fail",
+        help="Run, batch and profile modes only: what to do with a map or fold over --max-items (default fail)",
+    )
+
+    parser.add_argument(
+        "--max-branches",
+        type=int,
+        help="Run, batch and profile modes only: maximum map branches and fold items in the whole run, including nested ones",
+    )
+
+    parser.add_argument(
+        "-d", "--daemon",
+        action="store_true",
+        help="Compile and run modes only: submit the job to a worker started with 'serve'",
+    )
+
+    parser.add_argument(
+        "--socket",
+        help="Unix socket of the worker, for 'serve' and -d/--daemon (defaults to $VIBE_SOCKET or $LOG_DIR/vibe.sock)",
+    )
+
     parser.add_argument("-o", "--output", help="Output file (defaults to stdout)")
 
+    parser.add_argument(
+        "--trace",
+        help="Write a Chrome trace-event JSON timeline of the compile/run to this file (open in chrome://tracing or ui.perfetto.dev)",
+    )
+
     parser.add_argument(
         "--pretty",
         action="store_true",
         help="Compile mode only: output string representation instead of JSON",
     )
 
-    args = parser.parse_args()
+    args = parser.parse_intermixed_args()
 
-    # Enable debug logging if requested
-    log_file = create_log_file(
-        args.input,
-        args.mode
-    )
+    if args.mode == "serve":
+        from src.server import serve
+
+        create_log_file("serve", args.mode)
+        serve(args.socket)
+        return 0
 
     # Validate arguments
-    if args.compiled and args.mode != "run":
-        print("Error: -c/--compiled flag can only be used with 'run' mode")
+    if args.input is None:
+        print(f"Error: '{args.mode}' mode requires an input")
+        return 1
+
+    if args.compiled and args.mode not in ("run", "batch", "profile"):
+        print("Error: -c/--compiled flag can only be used with 'run', 'batch' or 'profile' mode")
+        return 1
+
+    if args.mode == "batch" and not args.params:
+        print("Error: 'batch' mode requires --params")
+        return 1
+
+    if args.params and args.mode != "batch":
+        print("Error: --params can only be used with 'batch' mode")
         return 1
 
     if args.compiled and args.script:
         print("Error: -c/--compiled flag cannot be used with -s/--script flag")
         return 1
 
+    if args.script and args.mode in ("estimate", "migrate"):
+        print(f"Error: -s/--script flag cannot be used with '{args.mode}' mode")
+        return 1
+
     if args.pretty and args.mode != "compile":
         print("Error: --pretty flag can only be used with 'compile' mode")
         return 1
 
+    if args.daemon and args.mode not in ("compile", "run"):
+        print("Error: -d/--daemon flag can only be used with 'compile' or 'run' mode")
+        return 1
+
+    if args.trace and (args.daemon or args.mode in ("estimate", "migrate")):
+        print("Error: --trace can only be used with jobs run in this process")
+        return 1
+
+    # The worker keeps its own log, so only log jobs run in this process
+    if not args.daemon:
+        create_log_file(args.input, args.mode)
+
+    if args.trace:
+        import atexit
+
+        from src.trace import start_tracing, write_trace
+
+        start_tracing()
+        # Written on exit, so failed runs are traced too
+        atexit.register(write_trace, args.trace)
+
+    # Plain data, so that it can be sent to a worker without importing pydantic
+    run_options = {
+        "map_parallelism": args.parallelism,
+        "branch_policy": {
+            "retries": args.branch_retries,
+            "fallback_model": args.fallback_model,
+            "on_failure": "record" if args.continue_on_error else "raise",
+        },
+        "local_ops": not args.no_local,
+        "max_branches": args.max_branches,
+    }
+    if args.max_items is not None:
+        run_options["fanout_limit"] = {
+            "max_items": args.max_items,
+            "overflow": args.overflow,
+        }
+
     if args.mode == "compile":
-        output = compile_mode(args.input, is_script=args.script, pretty=args.pretty)
+        output = compile_mode(
+            args.input,
+            is_script=args.script,
+            pretty=args.pretty,
+            daemon=args.daemon,
+            socket_path=args.socket,
+            parallel=args.parallel_compile,
+        )
     elif args.mode == "run":
-        output = run_mode(args.input, is_script=args.script, compiled=args.compiled)
+        output = run_mode(
+            args.input,
+            is_script=args.script,
+            compiled=args.compiled,
+            daemon=args.daemon,
+            socket_path=args.socket,
+            run_options=run_options,
+            parallel=args.parallel_compile,
+        )
+    elif args.mode == "batch":
+        output = batch_mode(
+            args.input,
+            args.params,
+            is_script=args.script,
+            compiled=args.compiled,
+            max_jobs=args.jobs,
+            run_options=run_options,
+            parallel=args.parallel_compile,
+        )
+    elif args.mode == "profile":
+        output = profile_mode(
+            args.input,
+            is_script=args.script,
+            compiled=args.compiled,
+            run_options=run_options,
+            parallel=args.parallel_compile,
+        )
+    elif args.mode == "estimate":
+        output = estimate_mode(args.input, args.parallelism, args.max_items)
+    elif args.mode == "migrate":
+        output = migrate_mode(args.input)
 
     if args.output:
-        os.makedirs(os.path.dirname(args.output), exist_ok=True)
+        os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
         with open(args.output, 'w') as f:
             f.write(output)
     else:
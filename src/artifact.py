@@ -0,0 +1,246 @@
+"""
+Reading and writing compiled programs (.vibec files).
+
+A .vibec file is a JSON envelope around the program:
+
+{
+  "format": "vibec",
+  "version": 2,
+  "source_hash": sha256 of the .vibe source, if known,
+  "program_hash": sha256 of the tools, schemas and program below,
+  "tools": {tool name: tool},
+  "schemas": {schema key: JSON schema},
+  "program": [statements]
+}
+
+Each statement is tagged with its "node" type, and refers to its tools and
+response schema by name/key, so each distinct tool or schema is stored (and
+validated) only once.
+
+If the program hash matches, the file was written by `dump_program` and hasn't
+been edited since, so `load_program` builds the program without re-validating
+it. Otherwise, or for files in an older format, it's fully validated.
+
+Older formats are migrated on load:
+- version 0: a bare {"statements": [...]} whose nodes have a "node_type" and
+  whose tools are names.
+- version 1: a bare {"statements": [...]} as written by `Program.model_dump_json`.
+"""
+
+import hashlib
+import json
+
+from pydantic import TypeAdapter
+
+from src.program import BranchPolicy, Command, FanoutLimit, Fold, LocalOp, Map, Program
+from src.schemas import JsonSchema
+from src.tools import TOOLS_BY_NAME, Tool
+
+FORMAT_VERSION = 2
+
+NODE_TYPES = {"Command": Command, "Map": Map, "Fold": Fold}
+
+# Fields of statements which hold other models, for building them unvalidated
+NESTED_MODELS = {"policy": BranchPolicy, "limit": FanoutLimit, "local": LocalOp}
+
+
+def source_hash(lines: list[str]) -> str:
+    """Hash the source of a vibe program, to tell which source an artifact came from."""
+    source = "\n".join(line.rstrip("\n") for line in lines)
+    return hashlib.sha256(source.encode("utf-8")).hexdigest()
+
+
+def dump_program(program: Program, source_hash: str | None = None) -> str:
+    """Serialize a program into the current .vibec format."""
+    tools: dict[str, dict] = {}
+    schemas: dict[str, dict] = {}
+    statements = [
+        _intern(stmt, tools, schemas)
+        for stmt in program.model_dump(mode="json")["statements"]
+    ]
+    return _dump_envelope(tools, schemas, statements, source_hash)
+
+
+def load_program(content: str, validate: bool = False) -> Program:
+    """
+    Load a program from a .vibec file in any supported format.
+
+    Unless `validate` is set, programs whose hash matches are built without
+    re-validating them.
+    """
+    envelope = _migrate(json.loads(content))
+
+    trusted = not validate and envelope["program_hash"] == _program_hash(envelope)
+    if trusted:
+        return _construct(envelope)
+
+    return Program.model_validate({"statements": _expand(envelope)})
+
+
+def upgrade_artifact(content: str) -> str:
+    """Rewrite a .vibec file from any supported format in the current one."""
+    envelope = _migrate(json.loads(content))
+    program = Program.model_validate({"statements": _expand(envelope)})
+    return dump_program(program, envelope["source_hash"])
+
+
+def _dump_envelope(
+    tools: dict, schemas: dict, statements: list, source_hash: str | None
+) -> str:
+    envelope = {
+        "format": "vibec",
+        "version": FORMAT_VERSION,
+        "source_hash": source_hash,
+        "program_hash": None,
+        "tools": tools,
+        "schemas": schemas,
+        "program": statements,
+    }
+    envelope["program_hash"] = _program_hash(envelope)
+    return json.dumps(envelope, indent=2)
+
+
+def _program_hash(envelope: dict) -> str:
+    content = json.dumps(
+        [envelope["tools"], envelope["schemas"], envelope["program"]],
+        sort_keys=True,
+        separators=(",", ":"),
+    )
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+def _node_type(stmt: dict) -> str:
+    node = stmt.get("node") or stmt.get("node_type")
+    if node:
+        return node
+    if "dimension" in stmt:
+        return "Fold" if "state" in stmt else "Map"
+    return "Command"
+
+
+def _intern(stmt: dict, tools: dict, schemas: dict) -> dict:
+    """
+    Convert a statement from its pydantic (or legacy) layout to the current one,
+    moving its tools and schemas into the shared tables.
+    """
+    interned = {"node": _node_type(stmt)}
+    for key, value in stmt.items():
+        if key in ("node", "node_type"):
+            continue
+        elif key == "dimension":
+            interned[key] = _intern(value, tools, schemas)
+        elif key == "body":
+            statements = value["statements"] if isinstance(value, dict) else value
+            interned[key] = [_intern(s, tools, schemas) for s in statements]
+        elif key == "tools":
+            interned[key] = [_intern_tool(tool, tools) for tool in value]
+        elif key == "response_schema" and value is not None:
+            interned[key] = _intern_schema(value, schemas)
+        else:
+            interned[key] = value
+    return interned
+
+
+def _intern_tool(tool: str | dict, tools: dict) -> str:
+    if isinstance(tool, str):
+        # Legacy files refer to tools by name
+        if tool not in TOOLS_BY_NAME:
+            raise ValueError(f"Unknown tool: {tool}")
+        tool = TOOLS_BY_NAME[tool].model_dump(mode="json")
+    tools.setdefault(tool["tool_name"], tool)
+    return tool["tool_name"]
+
+
+def _intern_schema(schema: dict, schemas: dict) -> str:
+    jsonschema = schema.get("jsonschema", schema)
+    content = json.dumps(jsonschema, sort_keys=True, separators=(",", ":"))
+    key = hashlib.sha256(content.encode("utf-8")).hexdigest()[:12]
+    schemas.setdefault(key, jsonschema)
+    return key
+
+
+def _migrate(data: dict) -> dict:
+    """Bring the contents of a .vibec file of any version up to the current envelope."""
+    if data.get("format") == "vibec":
+        if data["version"] > FORMAT_VERSION:
+            raise ValueError(
+                f"Compiled program is format version {data['version']}, "
+                f"but this version of vibe-compiler only reads up to {FORMAT_VERSION}"
+            )
+        return data
+
+    # Versions 0 and 1 are bare programs. Interning them gives the current
+    # layout, but with no hash, so they're always validated.
+    tools: dict[str, dict] = {}
+    schemas: dict[str, dict] = {}
+    statements = [_intern(stmt, tools, schemas) for stmt in data["statements"]]
+    return {
+        "format": "vibec",
+        "version": FORMAT_VERSION,
+        "source_hash": None,
+        "program_hash": None,
+        "tools": tools,
+        "schemas": schemas,
+        "program": statements,
+    }
+
+
+def _expand(envelope: dict) -> list[dict]:
+    """Statements in their pydantic layout, for validation."""
+
+    def expand(stmt: dict) -> dict:
+        fields = {}
+        for key, value in stmt.items():
+            if key == "node":
+                continue
+            elif key == "dimension":
+                fields[key] = expand(value)
+            elif key == "body":
+                fields[key] = {"statements": [expand(s) for s in value]}
+            elif key == "tools":
+                fields[key] = [envelope["tools"][name] for name in value]
+            elif key == "response_schema" and value is not None:
+                fields[key] = {"jsonschema": envelope["schemas"][value]}
+            else:
+                fields[key] = value
+        return fields
+
+    return [expand(stmt) for stmt in envelope["program"]]
+
+
+def _construct(envelope: dict) -> Program:
+    """Build a program from a trusted envelope without validating it."""
+    tool_adapter = TypeAdapter(Tool)
+    tools = {
+        name: tool_adapter.validate_python(tool)
+        for name, tool in envelope["tools"].items()
+    }
+    schemas = {
+        key: JsonSchema.model_construct(jsonschema=schema)
+        for key, schema in envelope["schemas"].items()
+    }
+
+    def construct(stmt: dict):
+        fields = {}
+        for key, value in stmt.items():
+            if key == "node":
+                continue
+            elif key == "dimension":
+                fields[key] = construct(value)
+            elif key == "body":
+                fields[key] = Program.model_construct(
+                    statements=[construct(s) for s in value]
+                )
+            elif key == "tools":
+                fields[key] = [tools[name] for name in value]
+            elif key == "response_schema" and value is not None:
+                fields[key] = schemas[value]
+            elif key in NESTED_MODELS and value is not None:
+                fields[key] = NESTED_MODELS[key].model_construct(**value)
+            else:
+                fields[key] = value
+        return NODE_TYPES[stmt["node"]].model_construct(**fields)
+
+    return Program.model_construct(
+        statements=[construct(stmt) for stmt in envelope["program"]]
+    )
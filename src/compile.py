@@ -1,25 +1,36 @@
 from collections.abc import Sequence
+from concurrent.futures import ThreadPoolExecutor
+from itertools import repeat
 from typing import Literal
 
 from pydantic import BaseModel
 from tqdm import tqdm
 
 from src.llm import LLM, Conversation
-from src.program import Command, Map, Program, Statement
+from src.program import Command, Fold, LocalOp, Map, Program, Statement
 from src.prompts import (
     COMPILER_SYSTEM_PROMPT,
     classification_prompt,
     require_json_list_prompt,
     retry_classification_prompt,
 )
-from src.schemas import GENERIC_LIST_SCHEMA, get_compile_schema
+from src.schemas import GENERIC_LIST_SCHEMA, OUTPUT_SCHEMAS, get_compile_schema
 from src.tools import TOOLS_BY_NAME
+from src.trace import in_context, span
+
+# Maximum number of blocks compiled concurrently in parallel mode.
+COMPILE_PARALLELISM = 8
 
 
 class CompileResponse(BaseModel):
-    type: Literal["Map", "EndMap", "Command"]
+    type: Literal["Map", "Fold", "EndMap", "Command"]
     tools: list[str]
     files: list[str] = []
+    state: str | None = None
+    stop_when: str | None = None
+    output: Literal["text", "number", "boolean", "list", "table"] = "text"
+    local_op: str = "none"
+    local_arg: str | None = None
 
 
 def parse_tools(tools: Sequence[str]):
@@ -27,58 +38,175 @@ def parse_tools(tools: Sequence[str]):
     return [TOOLS_BY_NAME[t] for t in tools]
 
 
-def compile(lines: list[str]) -> Program:
+def compile(
+    lines: list[str], llm: LLM | None = None, parallel: bool = False
+) -> Program:
     """
     Compile a vibe into an program.
 
     Algorithm:
     1. Read file line by line
     2. For each non-empty line:
-       a. Ask LLM: "What should we do at this statement?" (Map/EndMap/Command)
+       a. Ask LLM: "What should we do at this statement?" (Map/Fold/EndMap/Command)
        b. Generate the AST node JSON for the line.
        c. Parse JSON response into appropriate AST node
     3. Return Program of all top-level statements
+
+    With `parallel`, see `compile_parallel`.
     """
+    if llm is None:
+        llm = LLM.from_env()
+
+    if parallel:
+        return compile_parallel(lines, llm)
 
-    llm = LLM.from_env()
     conversation = llm.converse(COMPILER_SYSTEM_PROMPT)
 
     statements: list[Statement] = []
-    map_stack: list[Map] = []  # Stack to track nested map statements
+    map_stack: list[Map | Fold] = []  # Stack to track nested map/fold statements
 
     # Filter out empty lines for progress tracking
     non_empty_lines = [line.strip() for line in lines if line.strip()]
 
-    for line_num, line in enumerate(
-        tqdm(non_empty_lines, desc="Compiling lines", unit="line", ncols=0)
-    ):
-        try:
-            advance(line, statements, map_stack, conversation)
-        except Exception as e:
-            raise ValueError(f"Failed to compile line {line_num}: '{line}'") from e
+    with span("compile", lines=len(non_empty_lines)):
+        for line_num, line in enumerate(
+            tqdm(non_empty_lines, desc="Compiling lines", unit="line", ncols=0)
+        ):
+            try:
+                with span("compile line", line=line, line_num=line_num):
+                    advance(line, statements, map_stack, conversation)
+            except Exception as e:
+                raise ValueError(f"Failed to compile line {line_num}: '{line}'") from e
 
     return Program(statements=statements)
 
 
+def split_blocks(lines: list[str]) -> list[list[str]]:
+    """
+    Split a vibe into blocks which can be compiled independently.
+
+    A block is a line at the outermost indentation, along with every more
+    deeply indented line after it, i.e. a top-level statement and, if it's a
+    loop, its body. Lines are stripped, as for the sequential compiler.
+    """
+    non_empty_lines = [line.rstrip().expandtabs() for line in lines if line.strip()]
+    if not non_empty_lines:
+        return []
+
+    def indent(line: str) -> int:
+        return len(line) - len(line.lstrip())
+
+    base = min(indent(line) for line in non_empty_lines)
+
+    blocks: list[list[str]] = []
+    for line in non_empty_lines:
+        if not blocks or indent(line) <= base:
+            blocks.append([line.strip()])
+        else:
+            blocks[-1].append(line.strip())
+    return blocks
+
+
+def compile_parallel(lines: list[str], llm: LLM) -> Program:
+    """
+    Compile a vibe by compiling its blocks concurrently.
+
+    1. Split the lines into blocks by indentation (see `split_blocks`).
+    2. Compile each block with `advance`, concurrently, each in a fresh
+       conversation which only sees that block's lines.
+    3. Stitch the blocks back together in order. If a block leaves a Map or
+       Fold open, ask whether the first line of the next block ends it, as the
+       sequential compiler would, and nest the block inside it if not.
+
+    A 100-line vibe with a dozen top-level statements takes roughly as long as
+    its largest block, plus one call for each block that follows an open loop.
+
+    Blocks come from indentation only, so a vibe without indented lines (e.g.
+    any inline script) has one block per line, and reconciling them would take
+    more calls than compiling sequentially. Such vibes are compiled with the
+    sequential compiler instead.
+    """
+    blocks = split_blocks(lines)
+    if all(len(block) == 1 for block in blocks):
+        print("No indented blocks to compile in parallel, compiling sequentially")
+        return compile(lines, llm)
+
+    def compile_block(
+        block: list[str], llm: LLM
+    ) -> tuple[list[Statement], list[Map | Fold]]:
+        conversation = llm.converse(COMPILER_SYSTEM_PROMPT)
+        statements: list[Statement] = []
+        map_stack: list[Map | Fold] = []
+        with span("compile block", first_line=block[0], lines=len(block)):
+            for line in block:
+                try:
+                    with span("compile line", line=line):
+                        advance(line, statements, map_stack, conversation)
+                except Exception as e:
+                    raise ValueError(f"Failed to compile line: '{line}'") from e
+        return statements, map_stack
+
+    with span("compile", lines=sum(len(block) for block in blocks), parallel=True):
+        with ThreadPoolExecutor(max_workers=COMPILE_PARALLELISM) as executor:
+            compiled_blocks = list(
+                tqdm(
+                    executor.map(in_context(compile_block), blocks, repeat(llm)),
+                    total=len(blocks),
+                    desc="Compiling blocks",
+                    unit="block",
+                    ncols=0,
+                )
+            )
+
+        # Reconcile block boundaries in one conversation, which only ever holds
+        # these questions rather than the whole program.
+        conversation = llm.converse(COMPILER_SYSTEM_PROMPT)
+        statements: list[Statement] = []
+        map_stack: list[Map | Fold] = []
+
+        for block, (block_statements, block_stack) in zip(blocks, compiled_blocks):
+            with span("reconcile block", first_line=block[0], open_loops=len(map_stack)):
+                while map_stack and _ends_map(block[0], map_stack[-1], conversation):
+                    map_stack.pop()
+
+            if map_stack:
+                map_stack[-1].body.statements.extend(block_statements)
+            else:
+                statements.extend(block_statements)
+            map_stack.extend(block_stack)
+
+    return Program(statements=statements)
+
+
+def _ends_map(line: str, open_map: Map | Fold, conversation: Conversation) -> bool:
+    """Whether `line` ends the open Map or Fold, as `advance` would decide."""
+    schema = get_compile_schema(["Map", "Fold", "Command", "EndMap"])
+    response = conversation.chat(
+        classification_prompt(line, open_map.dimension.prompt),
+        response_schema=schema.jsonschema,
+    )
+    return CompileResponse.model_validate_json(response).type == "EndMap"
+
+
 def advance(
     line: str,
     statements: list[Statement],
-    map_stack: list[Map],
+    map_stack: list[Map | Fold],
     conversation: Conversation,
 ):
     """
     Compile one line of the program. This returns nothing, but will either:
     - append a command to statements
-    - append a command to the last map in the stack
-    - pop the last map in the stack and append it to statements, calling this function again.
+    - append a command to the last map or fold in the stack
+    - pop the last map or fold in the stack and append it to statements, calling this function again.
     """
     # Step 1: Classify the line type and get tools in one call
 
     if map_stack:
-        allowed_commands = ["Map", "Command", "EndMap"]
+        allowed_commands = ["Map", "Fold", "Command", "EndMap"]
         last_map = map_stack[-1].dimension.prompt
     else:
-        allowed_commands = ["Map", "Command"]
+        allowed_commands = ["Map", "Fold", "Command"]
         last_map = None
 
     schema = get_compile_schema(allowed_commands)
@@ -102,8 +230,8 @@ def advance(
             compiled = CompileResponse.model_validate_json(retry_response)
 
     # Step 2: Generate AST node based on type and handle nesting
-    elif compiled.type == "Map":
-        # Create new map and push to stack
+    elif compiled.type in ("Map", "Fold"):
+        # Create new map or fold and push to stack
 
         dim_cmd = Command(
             prompt=require_json_list_prompt(line),
@@ -113,7 +241,15 @@ def advance(
             response_schema = GENERIC_LIST_SCHEMA if not compiled.tools else None
         )
 
-        new_map = Map(dimension=dim_cmd, body=Program(statements=[]))
+        if compiled.type == "Fold":
+            new_map = Fold(
+                dimension=dim_cmd,
+                body=Program(statements=[]),
+                state=compiled.state or "the result so far",
+                stop_when=compiled.stop_when or None,
+            )
+        else:
+            new_map = Map(dimension=dim_cmd, body=Program(statements=[]))
 
         if map_stack:
             map_stack[-1].body.statements.append(new_map)
@@ -123,7 +259,18 @@ def advance(
 
     elif compiled.type == "Command":
         command = Command(
-            prompt=line, tools=parse_tools(compiled.tools), files=compiled.files
+            prompt=line,
+            tools=parse_tools(compiled.tools),
+            files=compiled.files,
+            # Gemini doesn't support tools + jsonschema in the same request
+            response_schema=(
+                OUTPUT_SCHEMAS.get(compiled.output) if not compiled.tools else None
+            ),
+            local=(
+                LocalOp(op=compiled.local_op, arg=compiled.local_arg or None)
+                if compiled.local_op != "none"
+                else None
+            ),
         )
 
         # If we're inside a map, add to its body, otherwise add to main statements
@@ -0,0 +1,236 @@
+"""
+Predicting the cost of running a compiled program before running it.
+
+The estimate walks the program tree using statistics from previous runs
+(see `Telemetry.save`): the average length of map/fold lists, tokens per call
+and latency per model. Without any history, it falls back to rough defaults.
+
+These are estimates of the typical case. A fold with a `stop_when` condition
+is counted as running over its whole list, so its figures are an upper bound.
+"""
+
+import json
+import math
+import os
+
+from pydantic import BaseModel
+
+from src.program import Command, Fold, Map, Program, Statement
+from src.run import REDUCE_GROUP_SIZE
+from src.telemetry import STATS_FILE
+
+# Used when there's no history for a statistic
+DEFAULT_DIMENSION_ITEMS = 10.0
+DEFAULT_PROMPT_TOKENS = 2000.0
+DEFAULT_OUTPUT_TOKENS = 300.0
+DEFAULT_LATENCY_SECONDS = 5.0
+
+# Rough in-memory size of one token of a request payload, including copies
+# made while building and encoding it.
+BYTES_PER_TOKEN = 16
+# Memory used by the interpreter, libraries and so on
+BASE_MEMORY_BYTES = 100 * 1024 * 1024
+
+# Estimates above these are flagged
+MAX_SAFE_CALLS = 1000
+MAX_SAFE_FANOUT = 500
+
+
+class Stats(BaseModel):
+    """Averages from previous runs."""
+
+    dimension_items: float = DEFAULT_DIMENSION_ITEMS
+    prompt_tokens: float = DEFAULT_PROMPT_TOKENS
+    output_tokens: float = DEFAULT_OUTPUT_TOKENS
+    latency_seconds: float = DEFAULT_LATENCY_SECONDS
+    runs: int = 0
+
+
+class Estimate(BaseModel):
+    calls: float = 0
+    prompt_tokens: float = 0
+    output_tokens: float = 0
+    # Wall time along the critical path, given the parallelism
+    wall_seconds: float = 0
+    # Total number of map/fold branches, including nested ones
+    fanout: float = 0
+    peak_memory_bytes: float = 0
+    warnings: list[str] = []
+
+    def __str__(self) -> str:
+        lines = [
+            f"LLM calls:     {self.calls:,.0f}",
+            f"Prompt tokens: {self.prompt_tokens:,.0f}",
+            f"Output tokens: {self.output_tokens:,.0f}",
+            f"Wall time:     {self.wall_seconds:,.0f}s",
+            f"Branches:      {self.fanout:,.0f}",
+            f"Peak memory:   {self.peak_memory_bytes / 1024 / 1024:,.0f}MB",
+        ]
+        lines += [f"Warning: {warning}" for warning in self.warnings]
+        return "\n".join(lines)
+
+
+def load_stats(model: str | None = None, filename: str = STATS_FILE) -> Stats:
+    """
+    Average the statistics of all previous runs recorded in `filename`.
+
+    Token counts and latency are for `model` if given, otherwise for all models.
+    """
+    if not os.path.exists(filename):
+        return Stats()
+
+    totals: dict[str, list[float]] = {}
+
+    def add(name: str, count: int, mean: float):
+        total = totals.setdefault(name, [0, 0.0])
+        total[0] += count
+        total[1] += count * mean
+
+    runs = 0
+    with open(filename) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            summary = json.loads(line)
+            runs += 1
+            for name, sample in summary.get("samples", {}).items():
+                kind, _, sample_model = name.partition(":")
+                if model is None or sample_model in ("", model):
+                    add(kind, sample["count"], sample["mean"])
+            for latency_model, latency in summary.get("latency", {}).items():
+                if model is None or latency_model == model:
+                    add("latency", latency["calls"], latency["mean_seconds"])
+
+    def mean(name: str, default: float) -> float:
+        count, total = totals.get(name, (0, 0.0))
+        return total / count if count else default
+
+    return Stats(
+        dimension_items=mean("dimension_items", DEFAULT_DIMENSION_ITEMS),
+        prompt_tokens=mean("prompt_tokens", DEFAULT_PROMPT_TOKENS),
+        output_tokens=mean("output_tokens", DEFAULT_OUTPUT_TOKENS),
+        latency_seconds=mean("latency", DEFAULT_LATENCY_SECONDS),
+        runs=runs,
+    )
+
+
+def estimate_program(
+    program: Program,
+    stats: Stats,
+    map_parallelism: int = 4,
+    max_concurrency: int = 8,
+    max_items: int | None = None,
+) -> Estimate:
+    """
+    Estimate the cost of running `program` with the given limits.
+
+    `max_items` caps the list of folds, and of maps without their own limit.
+    """
+    estimate = _estimate_program(program, stats, map_parallelism, max_items)
+
+    # However parallel the maps, there are at most `max_concurrency` requests
+    # in flight.
+    serial_seconds = estimate.calls * stats.latency_seconds
+    estimate.wall_seconds = max(
+        estimate.wall_seconds, serial_seconds / max_concurrency
+    )
+
+    in_flight = min(max_concurrency, max(1.0, estimate.fanout))
+    estimate.peak_memory_bytes = (
+        BASE_MEMORY_BYTES + in_flight * stats.prompt_tokens * BYTES_PER_TOKEN
+    )
+
+    if estimate.calls > MAX_SAFE_CALLS:
+        estimate.warnings.append(
+            f"~{estimate.calls:,.0f} LLM calls; check for runaway fan-out"
+        )
+    if estimate.fanout > MAX_SAFE_FANOUT:
+        estimate.warnings.append(
+            f"~{estimate.fanout:,.0f} branches; nested maps multiply their lists"
+        )
+    if stats.runs == 0:
+        estimate.warnings.append("no previous runs recorded, so using defaults")
+    return estimate
+
+
+def _estimate_program(
+    program: Program, stats: Stats, parallelism: int, max_items: int | None
+) -> Estimate:
+    total = Estimate()
+    for stmt in program.statements:
+        _add(total, _estimate_statement(stmt, stats, parallelism, max_items))
+    return total
+
+
+def _estimate_statement(
+    stmt: Statement, stats: Stats, parallelism: int, max_items: int | None
+) -> Estimate:
+    if isinstance(stmt, Command):
+        # Assuming a command's local operation can be used, it makes no calls
+        return Estimate() if stmt.local else _calls(1, stats)
+
+    items = stats.dimension_items
+    dimension = _calls(1, stats)
+    body = _estimate_program(stmt.body, stats, parallelism, max_items)
+
+    if isinstance(stmt, Fold):
+        # Folds have no limit of their own, but count towards the run's
+        if max_items is not None:
+            items = min(items, max_items)
+        # Items run one after another, each with an optional stop check
+        per_item = _calls(1 if stmt.stop_when else 0, stats)
+        _add(per_item, body)
+        estimate = _scaled(per_item, items)
+        _add(estimate, dimension)
+        return estimate
+
+    assert isinstance(stmt, Map)
+    limit = stmt.limit.max_items if stmt.limit else max_items
+    if limit is not None:
+        items = min(items, limit)
+    estimate = _scaled(body, items)
+    # Branches run in waves of `parallelism`
+    estimate.wall_seconds = math.ceil(items / parallelism) * body.wall_seconds
+    _add(estimate, dimension)
+    _add(estimate, _reduce_calls(items, stats))
+    return estimate
+
+
+def _reduce_calls(items: float, stats: Stats) -> Estimate:
+    """The calls made to tree-reduce `items` map results."""
+    estimate = Estimate()
+    while items > REDUCE_GROUP_SIZE:
+        groups = math.ceil(items / REDUCE_GROUP_SIZE)
+        level = _calls(groups, stats)
+        # Each level's groups are reduced concurrently
+        level.wall_seconds = stats.latency_seconds
+        _add(estimate, level)
+        items = groups
+    return estimate
+
+
+def _calls(n: float, stats: Stats) -> Estimate:
+    return Estimate(
+        calls=n,
+        prompt_tokens=n * stats.prompt_tokens,
+        output_tokens=n * stats.output_tokens,
+        wall_seconds=n * stats.latency_seconds,
+    )
+
+
+def _scaled(estimate: Estimate, n: float) -> Estimate:
+    return Estimate(
+        calls=estimate.calls * n,
+        prompt_tokens=estimate.prompt_tokens * n,
+        output_tokens=estimate.output_tokens * n,
+        wall_seconds=estimate.wall_seconds * n,
+        fanout=(estimate.fanout + 1) * n,
+    )
+
+
+def _add(total: Estimate, other: Estimate):
+    total.calls += other.calls
+    total.prompt_tokens += other.prompt_tokens
+    total.output_tokens += other.output_tokens
+    total.wall_seconds += other.wall_seconds
+    total.fanout += other.fanout
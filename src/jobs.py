@@ -0,0 +1,131 @@
+"""
+Running one program many times, once per row of a parameter table.
+
+Prompts can refer to a row's columns as `{column}`. Any columns which no prompt
+refers to are given to the run as inputs at the start of its conversation.
+
+All jobs share one LLM client, so its connection pool and concurrency limit
+apply across all of them. A failing job doesn't affect the others.
+"""
+
+import re
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from pydantic import BaseModel
+from tqdm import tqdm
+
+from src.llm import LLM
+from src.program import Command, Program, Statement
+from src.run import RunOptions, run_program
+from src.trace import in_context, span
+
+PLACEHOLDER = re.compile(r"\{(\w+)\}")
+
+
+class JobResult(BaseModel):
+    row: dict[str, str]
+    output: str | None = None
+    error: str | None = None
+
+
+def placeholders(program: Program) -> set[str]:
+    """Names of all `{placeholders}` used in a program's prompts."""
+    names: set[str] = set()
+
+    def visit(stmt: Statement):
+        if isinstance(stmt, Command):
+            names.update(PLACEHOLDER.findall(stmt.prompt))
+        else:
+            visit(stmt.dimension)
+            for s in stmt.body.statements:
+                visit(s)
+
+    for stmt in program.statements:
+        visit(stmt)
+    return names
+
+
+def fill_program(program: Program, params: dict[str, str]) -> Program:
+    """A copy of the program with `{placeholders}` replaced by `params`."""
+
+    def fill(text: str) -> str:
+        return PLACEHOLDER.sub(
+            lambda m: str(params[m.group(1)]) if m.group(1) in params else m.group(0),
+            text,
+        )
+
+    def visit(stmt: Statement) -> Statement:
+        if isinstance(stmt, Command):
+            return stmt.model_copy(
+                update={
+                    "prompt": fill(stmt.prompt),
+                    "files": [fill(f) for f in stmt.files],
+                }
+            )
+        return stmt.model_copy(
+            update={
+                "dimension": visit(stmt.dimension),
+                "body": Program(statements=[visit(s) for s in stmt.body.statements]),
+            }
+        )
+
+    return Program(statements=[visit(stmt) for stmt in program.statements])
+
+
+def normalize_row(row: dict) -> dict[str, str]:
+    """
+    A row with only named columns and text values.
+
+    `csv.DictReader` gives `None` for missing cells and puts extra cells under
+    a `None` key.
+    """
+    return {
+        str(k): "" if v is None else str(v) for k, v in row.items() if k is not None
+    }
+
+
+def run_jobs(
+    program: Program,
+    rows: list[dict[str, str]],
+    llm: LLM | None = None,
+    max_jobs: int = 4,
+    options: RunOptions | None = None,
+) -> list[JobResult]:
+    """
+    Run `program` once per row, up to `max_jobs` at a time.
+
+    Returns one result per row, in the same order as `rows`.
+    """
+    if llm is None:
+        llm = LLM.from_env()
+
+    rows = [normalize_row(row) for row in rows]
+
+    used = placeholders(program)
+
+    def run_job(row: dict[str, str]) -> JobResult:
+        try:
+            inputs = {k: v for k, v in row.items() if k not in used}
+            with span("job", row=row):
+                output = run_program(fill_program(program, row), llm, inputs, options)
+            return JobResult(row=row, output=output)
+        except Exception as e:
+            return JobResult(row=row, error=f"{type(e).__name__}: {e}")
+
+    results: dict[int, JobResult] = {}
+    failed = 0
+    with ThreadPoolExecutor(max_workers=max_jobs) as executor:
+        futures = {
+            executor.submit(in_context(run_job), row): i for i, row in enumerate(rows)
+        }
+        progress = tqdm(
+            as_completed(futures), total=len(rows), desc="Running jobs", unit="job", ncols=0
+        )
+        for future in progress:
+            result = future.result()
+            results[futures[future]] = result
+            if result.error:
+                failed += 1
+                progress.set_postfix(failed=failed)
+
+    return [results[i] for i in range(len(rows))]
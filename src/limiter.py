@@ -0,0 +1,155 @@
+"""
+An adaptive limit on the number of LLM requests in flight.
+
+The limit follows AIMD (additive increase, multiplicative decrease), like TCP
+congestion control: while the provider isn't throttling or slowing down, each
+full round of requests raises the limit by one. A 429, or a sustained rise in
+latency, cuts it by `BACKOFF`. So it settles just below where the provider
+starts to push back, and follows it as that changes.
+
+Most of the variation in LLM latency comes from how much the model writes, not
+from load, so latency is compared per model and per output token. A rise only
+counts once the median of the last `LATENCY_WINDOW` requests is well above the
+model's long-run average, so single slow responses don't cause a backoff.
+
+There is one limiter per LLM client, so everything using the client (nested
+map branches, reducers, batch jobs, ...) shares it. Nested maps can have many
+threads waiting, but never more requests in flight than the limit.
+"""
+
+import statistics
+import threading
+from collections import deque
+
+from src.telemetry import Telemetry
+
+# Factor applied to the limit on a 429 or a latency rise
+BACKOFF = 0.5
+
+# Recent latency more than this many times the long-run average is a rise
+LATENCY_TOLERANCE = 1.5
+
+# Requests whose median is compared with the long-run average
+LATENCY_WINDOW = 20
+
+# Weight of each new sample in the long-run average. It's small, so that the
+# average only slowly gets used to a higher load.
+BASELINE_SMOOTHING = 0.01
+
+# Fixed cost of a request (connection, prompt processing), in output tokens,
+# added before dividing latency by the number of tokens written
+OVERHEAD_TOKENS = 50
+
+# Requests faster than this say nothing about congestion
+MIN_LATENCY_SECONDS = 0.1
+
+
+class _ModelLatency:
+    """Latency per output token of one model: recent samples and long-run average."""
+
+    def __init__(self):
+        self.recent: deque[float] = deque(maxlen=LATENCY_WINDOW)
+        self.baseline: float | None = None
+
+    def observe(self, seconds_per_token: float) -> bool:
+        """Add a sample, returning whether latency has risen."""
+        self.recent.append(seconds_per_token)
+        if len(self.recent) < LATENCY_WINDOW:
+            return False
+
+        recent = statistics.median(self.recent)
+        if self.baseline is None:
+            # Start from the first full window, rather than one sample
+            self.baseline = recent
+            return False
+        self.baseline += BASELINE_SMOOTHING * (seconds_per_token - self.baseline)
+        return recent > self.baseline * LATENCY_TOLERANCE
+
+    def reset(self):
+        # Measure the new, lower load from scratch before judging it
+        self.recent.clear()
+
+
+class AdaptiveLimiter:
+    def __init__(
+        self,
+        max_limit: int,
+        min_limit: int = 1,
+        initial: int | None = None,
+        telemetry: Telemetry | None = None,
+    ):
+        self.max_limit = max_limit
+        self.min_limit = min(min_limit, max_limit)
+        self.limit = float(initial or max(self.min_limit, max_limit // 2))
+        self.in_flight = 0
+        self.telemetry = telemetry
+        self._latency: dict[str, _ModelLatency] = {}
+        # Requests still in flight from before the last throttling backoff
+        self._stale = 0
+        self._condition = threading.Condition()
+        self._report()
+
+    def acquire(self, blocking: bool = True) -> bool:
+        """Take a slot, waiting for one if `blocking`. Returns whether one was taken."""
+        with self._condition:
+            while self.in_flight >= int(self.limit):
+                if not blocking:
+                    return False
+                self._condition.wait()
+            self.in_flight += 1
+            return True
+
+    def release(
+        self,
+        model: str,
+        latency: float | None = None,
+        output_tokens: int | None = None,
+        throttled: bool = False,
+    ):
+        """
+        Give back a slot, adjusting the limit by what the request observed.
+
+        `latency` is for successful requests only; failures other than
+        throttling don't say anything about congestion.
+        """
+        with self._condition:
+            # Whether the limit was being used fully, or this says little about it
+            saturated = self.in_flight >= int(self.limit)
+            self.in_flight -= 1
+            stale = self._stale > 0
+            self._stale = max(0, self._stale - 1)
+
+            if throttled:
+                # Requests sent before the limit dropped are likely throttled
+                # too, so only back off once for them.
+                if not stale:
+                    self._stale = self.in_flight
+                    self._back_off("throttled")
+            elif latency is not None:
+                if self._latency_rose(model, latency, output_tokens):
+                    self._latency[model].reset()
+                    self._back_off("latency")
+                elif saturated and self.limit < self.max_limit:
+                    # One more slot per round of requests at the current limit
+                    self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+                    self._report()
+
+            self._condition.notify_all()
+
+    def _latency_rose(
+        self, model: str, latency: float, output_tokens: int | None
+    ) -> bool:
+        if latency < MIN_LATENCY_SECONDS:
+            return False
+        tracker = self._latency.setdefault(model, _ModelLatency())
+        return tracker.observe(latency / ((output_tokens or 0) + OVERHEAD_TOKENS))
+
+    def _back_off(self, reason: str):
+        self.limit = max(self.min_limit, self.limit * BACKOFF)
+        if self.telemetry:
+            self.telemetry.count(f"concurrency_backoffs_{reason}")
+        self._report()
+
+    def _report(self):
+        if self.telemetry:
+            self.telemetry.gauge("concurrency_limit", int(self.limit))
@@ -1,17 +1,29 @@
+import json
 import os
+import threading
 import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
 from typing import Literal, Sequence
 
 import requests
 
+from src import profiler
+from src.limiter import AdaptiveLimiter
 from src.prompts import text_file_prompt
 from src.providers.gemini import parse_retry_delay
+from src.results import ResultsStore
+from src.telemetry import Telemetry
+from src.trace import in_context, span
 
 from .tools import Tool
 
 # Global debug file handle
 _log_file = None
 
+# Conversation turns longer than this many characters are kept in the results
+# store, rather than in memory.
+SPILL_THRESHOLD = 4096
+
 
 def set_log_file(filename: str):
     """Enable debug logging to a file."""
@@ -26,15 +38,68 @@ def _log(role: str, payload: dict):
         _log_file.flush()
 
 
+def _output_tokens(response: requests.Response) -> int | None:
+    try:
+        return response.json()["usageMetadata"]["candidatesTokenCount"]
+    except (ValueError, KeyError, TypeError):
+        return None
+
+
 class LLM:
-    def __init__(self, api_key, base_url: str, model: str | None):
+    """
+    A Gemini client, shared by everything in a run.
+
+    Requests in flight are limited adaptively (see `src.limiter`), between
+    `min_concurrency` and `max_concurrency`. Setting both the same gives a
+    fixed limit.
+
+    If `hedge_after` (seconds) or `hedge_percentile` is set, a request which
+    hasn't returned by then is sent again, and whichever response arrives first
+    is used. `hedge_percentile` uses the observed latency of the model once
+    there are enough samples, falling back to `hedge_after` until then. Hedges
+    are only sent when there's a spare concurrency slot.
+    """
+
+    def __init__(
+        self,
+        api_key,
+        base_url: str,
+        model: str | None,
+        max_concurrency: int = 8,
+        hedge_after: float | None = None,
+        hedge_percentile: float | None = None,
+        min_concurrency: int = 1,
+    ):
         self.api_key = api_key
         self.base_url = base_url.rstrip("/")
         self.model = model
+        # Reuse connections across requests, with one per concurrent request
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=max_concurrency)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.telemetry = Telemetry()
+        # Shared by everything using this client (map branches, batch jobs, ...)
+        self.max_concurrency = max_concurrency
+        self._limiter = AdaptiveLimiter(
+            max_concurrency, min_concurrency, telemetry=self.telemetry
+        )
+
+        self.hedge_after = hedge_after
+        self.hedge_percentile = hedge_percentile
+        # Sends hedged requests; each holds a slot, so this never queues.
+        self._hedge_executor = ThreadPoolExecutor(max_workers=max_concurrency)
+
+        # The usage of the last successful call made by each thread
+        self._usage = threading.local()
 
     @classmethod
     def from_env(cls):
         provider = os.environ["LLM_PROVIDER"]
+        if provider == "mock":
+            from src.providers.mock import MockLLM
+
+            return MockLLM.from_env()
 
         # TODO: with multiple providers, just instantiate the
         # one we want here.
@@ -42,8 +107,20 @@ class LLM:
         api_key = os.environ[f"{provider.upper()}_API_KEY"]
         url = os.environ[f"{provider.upper()}_URL"]
         model = os.environ[f"{provider.upper()}_MODEL"]
+        max_concurrency = int(os.getenv("LLM_MAX_CONCURRENCY", 8))
+        min_concurrency = int(os.getenv("LLM_MIN_CONCURRENCY", 1))
+        hedge_after = os.getenv("LLM_HEDGE_AFTER")
+        hedge_percentile = os.getenv("LLM_HEDGE_PERCENTILE")
         print(f"Using model {model} from provider {provider}")
-        return cls(api_key, url, model)
+        return cls(
+            api_key,
+            url,
+            model,
+            max_concurrency,
+            hedge_after=float(hedge_after) if hedge_after else None,
+            hedge_percentile=float(hedge_percentile) if hedge_percentile else None,
+            min_concurrency=min_concurrency,
+        )
 
     def chat(
         self,
@@ -88,8 +165,56 @@ class LLM:
         max_retries = 5
         base_delay = 1.0
 
-        for attempt in range(max_retries):
-            response = requests.post(
+        with span("llm.chat", model=model, turns=len(contents)):
+            for attempt in range(max_retries):
+                response = self._post(model, payload)
+
+                if response.ok:
+                    try:
+                        data = response.json()
+                        result = data["candidates"][0]["content"]["parts"][0]["text"]
+                        _log("ASSISTANT", result)
+                        self._record_usage(model, data.get("usageMetadata", {}))
+                        return result
+                    except:
+                        print(response.json()["candidates"][0])
+                        raise
+
+                # Handle rate limiting (429 errors)
+                if response.status_code == 429:
+                    self.telemetry.count("rate_limited")
+                    if attempt < max_retries:
+                        # Try to get retry delay from response
+                        retry_delay = parse_retry_delay(response) or base_delay * (
+                            2**attempt
+                        )
+
+                        print(
+                            f"Rate limited. Retrying in {retry_delay:.1f}s... (attempt {attempt + 1}/{max_retries})"
+                        )
+                        with span("rate limited", delay=retry_delay):
+                            time.sleep(retry_delay)
+                        continue
+
+            # For other errors or final attempt, raise the error
+            raise RuntimeError(response.json())
+
+    def last_prompt_tokens(self) -> int | None:
+        """Prompt tokens of the last call made by this thread, if the provider reported them."""
+        return getattr(self._usage, "usage", {}).get("promptTokenCount")
+
+    def _record_usage(self, model: str, usage: dict):
+        self._usage.usage = usage
+        if "promptTokenCount" in usage:
+            self.telemetry.observe(f"prompt_tokens:{model}", usage["promptTokenCount"])
+        if "candidatesTokenCount" in usage:
+            self.telemetry.observe(
+                f"output_tokens:{model}", usage["candidatesTokenCount"]
+            )
+
+    def _send(self, model: str, payload: dict) -> requests.Response:
+        with span("http request", model=model):
+            return self.session.post(
                 f"{self.base_url}/{model}:generateContent",
                 headers={
                     "Content-Type": "application/json",
@@ -98,45 +223,123 @@ class LLM:
                 json=payload,
             )
 
-            if response.ok:
-                try:
-                    result = response.json()["candidates"][0]["content"]["parts"][0][
-                        "text"
-                    ]
-                    _log("ASSISTANT", result)
-                    return result
-                except:
-                    print(response.json()["candidates"][0])
-                    raise
-
-            # Handle rate limiting (429 errors)
-            if response.status_code == 429:
-                if attempt < max_retries:
-                    # Try to get retry delay from response
-                    retry_delay = parse_retry_delay(response) or base_delay * (
-                        2**attempt
-                    )
-
-                    print(
-                        f"Rate limited. Retrying in {retry_delay:.1f}s... (attempt {attempt + 1}/{max_retries})"
-                    )
-                    time.sleep(retry_delay)
-                    continue
-
-        # For other errors or final attempt, raise the error
-        raise RuntimeError(response.json())
-
-    def converse(self, system_prompt: str, model: str | None = None):
+    def _post(self, model: str, payload: dict) -> requests.Response:
+        """Send one request, hedging it if configured."""
+        self.telemetry.count("requests")
+
+        hedge_after = self._hedge_delay(model)
+        if hedge_after is None:
+            self._limiter.acquire()
+            response = self._limited_send(model, payload)
+        else:
+            response = self._hedged_send(model, payload, hedge_after)
+        return response
+
+    def _limited_send(
+        self, model: str, payload: dict, primary: bool = True
+    ) -> requests.Response:
+        """
+        Send a request using a slot the caller has acquired, then release it,
+        telling the limiter how the request went.
+
+        Only the latency of `primary` requests is recorded: a hedge's would make
+        the model look faster than it is, and lower the hedging threshold.
+        """
+        start = time.monotonic()
+        response = None
+        try:
+            response = self._send(model, payload)
+            return response
+        finally:
+            latency = output_tokens = None
+            if response is not None and response.ok:
+                latency = time.monotonic() - start
+                output_tokens = _output_tokens(response)
+            if response is not None and primary:
+                self.telemetry.record_latency(model, time.monotonic() - start)
+            self._limiter.release(
+                model,
+                latency=latency,
+                output_tokens=output_tokens,
+                throttled=response is not None and response.status_code == 429,
+            )
+
+    def _hedge_delay(self, model: str) -> float | None:
+        if self.hedge_percentile is not None:
+            observed = self.telemetry.percentile(model, self.hedge_percentile)
+            if observed is not None:
+                return observed
+        return self.hedge_after
+
+    def _hedged_send(
+        self, model: str, payload: dict, hedge_after: float
+    ) -> requests.Response:
+        """
+        Send a request, and a duplicate if it's slower than `hedge_after`.
+
+        requests can't abort a request in flight, so the slower of the two is
+        left to finish in the background and its response is discarded. Each
+        holds a concurrency slot until it finishes, so hedges count against the
+        same limit as everything else.
+        """
+
+        def submit(primary: bool) -> Future:
+            return self._hedge_executor.submit(
+                in_context(self._limited_send), model, payload, primary
+            )
+
+        self._limiter.acquire()
+        primary = submit(True)
+        done, _ = wait([primary], timeout=hedge_after)
+        if done or not self._limiter.acquire(blocking=False):
+            return primary.result()
+
+        self.telemetry.count("hedged_requests")
+        with span("hedge", after=hedge_after):
+            hedge = submit(False)
+        pending = {primary, hedge}
+        while True:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            succeeded = [f for f in done if f.exception() is None]
+            # Wait for the other request if this one raised
+            if succeeded or not pending:
+                winner = succeeded[0] if succeeded else done.pop()
+                for other in pending:
+                    other.cancel()
+                if winner is hedge:
+                    self.telemetry.count("hedge_wins")
+                return winner.result()
+
+    def close(self):
+        """Close the connection pool and stop the hedging threads."""
+        self._hedge_executor.shutdown(wait=False)
+        self.session.close()
+
+    def converse(
+        self,
+        system_prompt: str,
+        model: str | None = None,
+        store: ResultsStore | None = None,
+    ):
         model = model or self.model
         assert model
-        return Conversation(self, model, system_prompt)
+        return Conversation(self, model, system_prompt, store)
 
 
 class Conversation:
-    def __init__(self, llm: "LLM", model: str, system_prompt: str | None = None):
+    def __init__(
+        self,
+        llm: "LLM",
+        model: str,
+        system_prompt: str | None = None,
+        store: ResultsStore | None = None,
+    ):
         self.llm = llm
         self.model = model
         self.system_prompt = system_prompt
+        self.store = store if store is not None else ResultsStore()
+        # Turns in Gemini's format, except that large parts hold a "ref" into
+        # the results store instead of their data. See `payload`.
         self.conversation: list[dict] = []
 
     def chat(
@@ -150,23 +353,96 @@ class Conversation:
         self.append_message(message, "user")
 
         # Send full conversation history
+        payload = self.payload()
         response = self.llm.chat(
-            self.conversation,
+            payload,
             system_instruction=self.system_prompt,
+            model=self.model,
             tools=tools,
             response_schema=response_schema,
         )
+        profiler.record_call(
+            self.system_prompt,
+            self.conversation,
+            payload,
+            self.llm.last_prompt_tokens(),
+        )
 
         # Add assistant response to contents
         self.append_message(response, "model")
 
         return response
 
-    def append_message(self, text: str, role: Literal["user", "model"]):
+    def append_message(
+        self, text: str, role: Literal["user", "model"], source: str | None = None
+    ):
         """
         Append some text to the conversation without calling the LLM.
+
+        `source` is what the text is, for profiling (see `src.profiler`).
         """
-        self.conversation.append({"role": role, "parts": [{"text": text}]})
+        self._append_turn({"role": role, "parts": [self._text_part(text)]}, source)
+
+    def _append_turn(self, turn: dict, source: str | None = None):
+        if profiler.enabled():
+            turn["statement"] = profiler.current_statement()
+            if source:
+                turn["source"] = source
+        self.conversation.append(turn)
+
+    def set_last_value(self, value, text: str | None = None):
+        """
+        Keep the parsed value of the last response alongside it, optionally
+        replacing its text with a rendering of the value.
+
+        Large values are kept in the results store like large turns, so that
+        forking the conversation doesn't copy them.
+        """
+        turn = self.conversation[-1]
+        encoded = json.dumps(value)
+        if len(encoded) > SPILL_THRESHOLD:
+            turn["value_ref"] = self.store.put(encoded)
+        else:
+            turn["value"] = value
+        if text is not None:
+            turn["parts"] = [self._text_part(text)]
+
+    @property
+    def last_value(self):
+        """The parsed value of the last turn, if it was structured output."""
+        if not self.conversation:
+            return None
+        turn = self.conversation[-1]
+        if "value_ref" in turn:
+            return json.loads(self.store.get(turn["value_ref"]))
+        return turn.get("value")
+
+    def _text_part(self, text: str) -> dict:
+        if len(text) > SPILL_THRESHOLD:
+            return {"ref": self.store.put(text)}
+        return {"text": text}
+
+    def payload(self) -> list[dict]:
+        """
+        The conversation in Gemini's format, with stored parts loaded back in.
+        """
+        return [
+            {"role": turn["role"], "parts": [self._load_part(p) for p in turn["parts"]]}
+            for turn in self.conversation
+        ]
+
+    def _load_part(self, part: dict) -> dict:
+        if "ref" in part:
+            return {"text": self.store.get(part["ref"])}
+        if "ref" in part.get("inline_data", {}):
+            inline_data = part["inline_data"]
+            return {
+                "inline_data": {
+                    "mime_type": inline_data["mime_type"],
+                    "data": self.store.get(inline_data["ref"]),
+                }
+            }
+        return part
 
     def append_text_file(self, filename: str):
         # Check if file exists
@@ -176,7 +452,9 @@ class Conversation:
         with open(filename, "r") as f:
             file_content = f.read()
         
-        self.append_message(text_file_prompt(filename, file_content), "user")
+        self.append_message(
+            text_file_prompt(filename, file_content), "user", source="attachments"
+        )
 
     def append_binary_file(self, filename):
         """
@@ -198,11 +476,17 @@ class Conversation:
                 f"File size {file_size} bytes exceeds 20MB limit ({max_size} bytes)"
             )
 
-        # Read and encode the file
-        with open(filename, "rb") as f:
-            file_content = f.read()
-            base64_content = base64.b64encode(file_content).decode("utf-8")
-
-        self.conversation.append(
-            {"inline_data": {"mime_type": "application/pdf", "data": base64_content}}
+        # Read and encode the file into the results store
+        with span("encode file", filename=filename, size=file_size):
+            with open(filename, "rb") as f:
+                base64_content = base64.b64encode(f.read()).decode("utf-8")
+            key = self.store.put(base64_content)
+            del base64_content
+
+        self._append_turn(
+            {
+                "role": "user",
+                "parts": [{"inline_data": {"mime_type": "application/pdf", "ref": key}}],
+            },
+            source="attachments",
         )
@@ -0,0 +1,229 @@
+"""
+Local operations: commands simple enough to run in-process instead of by the LLM.
+
+The compiler marks commands which match one of these operations (see
+`Command.local`), and the runner tries the operation before calling the LLM.
+Operations work on the structured value of the previous statement (see
+`Conversation.last_value`), e.g. a list from a command with an output schema
+or the results of a map, and return their result as both text and a value.
+
+Operations only run on structured values: a map's results are only kept as a
+value when every branch gave structured output. If there's no such value, or an
+operation can't handle it, it raises `LocalOpError` and the runner falls back to
+the LLM.
+"""
+
+import ast
+import csv
+import io
+import json
+import operator
+from datetime import date
+
+from src.program import LocalOp
+
+
+class LocalOpError(ValueError):
+    """A local operation couldn't handle its input."""
+
+
+# Largest exponent allowed in arithmetic, so `9**9**9` can't hang a run
+MAX_EXPONENT = 1000
+
+_BINARY_OPERATORS = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.Div: operator.truediv,
+    ast.FloorDiv: operator.floordiv,
+    ast.Mod: operator.mod,
+    ast.Pow: operator.pow,
+}
+
+_UNARY_OPERATORS = {ast.UAdd: operator.pos, ast.USub: operator.neg}
+
+
+def execute_local(op: LocalOp, value) -> tuple[str, object]:
+    """Run a local operation on the previous statement's value."""
+    try:
+        return LOCAL_OPS[op.op](value, op.arg)
+    except LocalOpError:
+        raise
+    except (ArithmeticError, TypeError, ValueError, KeyError) as e:
+        raise LocalOpError(f"{op.op} failed: {type(e).__name__}: {e}") from e
+
+
+def is_table(value) -> bool:
+    """Whether a value is a table: a non-empty list of rows."""
+    return isinstance(value, list) and bool(value) and all(
+        isinstance(row, list) for row in value
+    )
+
+
+def table_to_csv(rows: list[list]) -> str:
+    output = io.StringIO()
+    csv.writer(output, lineterminator="\n").writerows(rows)
+    return output.getvalue()
+
+
+def _arithmetic(value, expression: str | None) -> tuple[str, object]:
+    if not expression:
+        raise LocalOpError("arithmetic needs an expression")
+    result = _evaluate(ast.parse(expression, mode="eval").body)
+    if isinstance(result, float) and result.is_integer():
+        result = int(result)
+    return str(result), result
+
+
+def _evaluate(node: ast.AST):
+    if isinstance(node, ast.Constant) and type(node.value) in (int, float):
+        return node.value
+    if isinstance(node, ast.UnaryOp) and type(node.op) in _UNARY_OPERATORS:
+        return _UNARY_OPERATORS[type(node.op)](_evaluate(node.operand))
+    if isinstance(node, ast.BinOp) and type(node.op) in _BINARY_OPERATORS:
+        left, right = _evaluate(node.left), _evaluate(node.right)
+        if isinstance(node.op, ast.Pow) and abs(right) > MAX_EXPONENT:
+            raise LocalOpError(f"exponent too large: {right}")
+        return _BINARY_OPERATORS[type(node.op)](left, right)
+    raise LocalOpError(f"not plain arithmetic: {ast.dump(node)}")
+
+
+def _sort(value, key: str | None, reverse: bool = False) -> tuple[str, object]:
+    if is_table(value):
+        header, rows = value[0], value[1:]
+        if key and key not in header:
+            raise LocalOpError(f"no column {key!r} to sort by")
+        column = header.index(key) if key else 0
+        rows = sorted(rows, key=lambda row: _sort_key(row[column]), reverse=reverse)
+        return _render([header, *rows])
+
+    items = _list(value)
+    if key and all(isinstance(item, dict) for item in items):
+        items = sorted(items, key=lambda item: _sort_key(item[key]), reverse=reverse)
+    else:
+        items = sorted(items, key=_sort_key, reverse=reverse)
+    return _render(items)
+
+
+def _sort_descending(value, key: str | None) -> tuple[str, object]:
+    return _sort(value, key, reverse=True)
+
+
+def _sort_key(value):
+    # Numbers in text (e.g. from a table) sort as numbers
+    if isinstance(value, str):
+        try:
+            return (0, float(value), "")
+        except ValueError:
+            return (1, 0.0, value)
+    if isinstance(value, (int, float)):
+        return (0, value, "")
+    return (1, 0.0, json.dumps(value, sort_keys=True))
+
+
+def _dedupe(value, key: str | None) -> tuple[str, object]:
+    if is_table(value):
+        return _render([value[0], *_unique(value[1:])])
+    return _render(_unique(_list(value)))
+
+
+def _unique(items: list) -> list:
+    seen = set()
+    unique = []
+    for item in items:
+        identity = json.dumps(item, sort_keys=True)
+        if identity not in seen:
+            seen.add(identity)
+            unique.append(item)
+    return unique
+
+
+def _csv(value, arg: str | None) -> tuple[str, object]:
+    rows = _table(_list(value))
+    return table_to_csv(rows), rows
+
+
+def _json(value, arg: str | None) -> tuple[str, object]:
+    if value is None:
+        raise LocalOpError("no structured value to convert")
+    return json.dumps(value, indent=2), value
+
+
+def _date_prime_factors(value, date_format: str | None) -> tuple[str, object]:
+    # Today's date on this machine, which is what "today" means for a run
+    digits = date.today().strftime(date_format or "%d%m%y")
+    if not digits.isdigit():
+        raise LocalOpError(f"date format doesn't give a number: {date_format}")
+    number = int(digits)
+    factors = _prime_factors(number)
+    return f"{digits} = {' × '.join(str(f) for f in factors)}", factors
+
+
+def _prime_factors(n: int) -> list[int]:
+    if n < 2:
+        return []
+    factors = []
+    divisor = 2
+    while divisor * divisor <= n:
+        while n % divisor == 0:
+            factors.append(divisor)
+            n //= divisor
+        divisor += 1
+    if n > 1:
+        factors.append(n)
+    return factors
+
+
+def _list(value) -> list:
+    if not isinstance(value, list):
+        raise LocalOpError("the previous statement didn't give a list")
+    return value
+
+
+def _table(items: list) -> list[list]:
+    """Rows of a table, with a header row, from a list of records, rows or values."""
+    if is_table(items):
+        return [[_cell(cell) for cell in row] for row in items]
+
+    # Map results are {"item": ..., "result": ...}; flatten object results
+    records = [
+        {"item": item["item"], **item["result"]}
+        if _is_map_result(item) and isinstance(item["result"], dict)
+        else item
+        for item in items
+    ]
+    if records and all(isinstance(record, dict) for record in records):
+        header: list[str] = []
+        for record in records:
+            header += [k for k in record if k not in header]
+        rows = [[_cell(record.get(k, "")) for k in header] for record in records]
+        return [header, *rows]
+
+    return [["value"], *[[_cell(item)] for item in items]]
+
+
+def _is_map_result(item) -> bool:
+    return isinstance(item, dict) and item.keys() == {"item", "result"}
+
+
+def _cell(value) -> str:
+    if isinstance(value, str):
+        return value
+    return json.dumps(value)
+
+
+def _render(value) -> tuple[str, object]:
+    if is_table(value):
+        return table_to_csv(value), value
+    return json.dumps(value), value
+
+
+LOCAL_OPS = {
+    "arithmetic": _arithmetic,
+    "sort": _sort,
+    "sort_descending": _sort_descending,
+    "dedupe": _dedupe,
+    "csv": _csv,
+    "json": _json,
+    "date_prime_factors": _date_prime_factors,
+}
@@ -0,0 +1,203 @@
+"""
+Attributing the prompt tokens of every LLM call to where they came from.
+
+Each call's prompt is split by source:
+- system: the system prompt
+- history: earlier instructions and responses inherited by the conversation
+- attachments: files added to the conversation
+- map_context: the item given to a map branch (or fold step)
+- map_results: the results of a map (or fold) added to its parent conversation
+- instruction: the message which made this call
+
+and history-like tokens are also attributed to the statement which added them,
+to show which statements make every later request bigger.
+
+Token counts are estimated from the length of each part, then scaled to the
+count reported by the provider when there is one.
+
+Profiling is off unless `start_profiling` is called. Until then, conversations
+don't tag their turns and `statement` only tracks the current statement.
+"""
+
+import contextvars
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+
+from pydantic import BaseModel
+
+SOURCES = ["system", "history", "attachments", "map_context", "map_results", "instruction"]
+
+# Rough characters per token, for estimating the size of each part
+CHARS_PER_TOKEN = 4
+
+# Global profiler, if profiling is enabled
+_profiler: "Profiler | None" = None
+
+# The statement being executed in the current thread/task, e.g. "3.1"
+_current_statement: contextvars.ContextVar[str | None] = contextvars.ContextVar(
+    "current_statement", default=None
+)
+
+
+class CallProfile(BaseModel):
+    index: int
+    statement: str | None
+    prompt_tokens: float
+    # Whether `prompt_tokens` was reported by the provider, or estimated
+    reported: bool
+    by_source: dict[str, float]
+    # Tokens of earlier turns, by the statement which added them
+    by_origin: dict[str, float]
+
+
+class Profiler:
+    def __init__(self):
+        self.calls: list[CallProfile] = []
+        # Descriptions of statements, by label
+        self.statements: dict[str, str] = {}
+        self._lock = threading.Lock()
+
+    def record(self, call: CallProfile):
+        with self._lock:
+            call.index = len(self.calls) + 1
+            self.calls.append(call)
+
+    def report(self) -> str:
+        with self._lock:
+            calls = list(self.calls)
+
+        totals = defaultdict(float)
+        for call in calls:
+            for source, tokens in call.by_source.items():
+                totals[source] += tokens
+        total = sum(totals.values())
+
+        lines = [f"{len(calls)} calls, {total:,.0f} prompt tokens"]
+        lines += [
+            f"  {source:<12} {totals[source]:>12,.0f}  {_share(totals[source], total)}"
+            for source in SOURCES
+        ]
+
+        lines += ["", "Calls:"]
+        header = f"  {'call':>5} {'statement':<10} {'tokens':>9}"
+        header += "".join(f" {source:>12}" for source in SOURCES)
+        lines.append(header)
+        for call in calls:
+            row = f"  {call.index:>5} {call.statement or '-':<10} {call.prompt_tokens:>9,.0f}"
+            row += "".join(f" {call.by_source.get(source, 0):>12,.0f}" for source in SOURCES)
+            if not call.reported:
+                row += "  (estimated)"
+            lines.append(row)
+
+        # Tokens each statement added to the prompts of later calls
+        carried = defaultdict(float)
+        later_calls = defaultdict(int)
+        for call in calls:
+            for origin, tokens in call.by_origin.items():
+                carried[origin] += tokens
+                later_calls[origin] += 1
+
+        lines += ["", "Statements by tokens they add to later calls:"]
+        for label, tokens in sorted(carried.items(), key=lambda kv: -kv[1]):
+            description = self.statements.get(label, "")
+            lines.append(
+                f"  {label:<10} {tokens:>12,.0f} tokens over {later_calls[label]:>4} calls"
+                f"  {_share(tokens, total)}  {description}"
+            )
+        return "\n".join(lines)
+
+
+def start_profiling() -> Profiler:
+    """Enable profiling for the rest of this process."""
+    global _profiler
+    _profiler = Profiler()
+    return _profiler
+
+
+def enabled() -> bool:
+    return _profiler is not None
+
+
+@contextmanager
+def statement(label: str, description: str):
+    """Mark the statement being executed, for attributing the turns it adds."""
+    if _profiler is not None:
+        _profiler.statements.setdefault(label, _short(description))
+    token = _current_statement.set(label)
+    try:
+        yield
+    finally:
+        _current_statement.reset(token)
+
+
+def current_statement() -> str | None:
+    return _current_statement.get()
+
+
+def record_call(
+    system_prompt: str | None,
+    turns: list[dict],
+    payload: list[dict],
+    reported_tokens: int | None,
+):
+    """
+    Attribute the prompt of a call to its sources.
+
+    `turns` are the conversation's turns with their tags, and `payload` the same
+    turns with their stored parts loaded, as sent to the provider.
+    """
+    if _profiler is None:
+        return
+
+    by_source: dict[str, float] = defaultdict(float)
+    by_origin: dict[str, float] = defaultdict(float)
+    if system_prompt:
+        by_source["system"] += _estimate(system_prompt)
+
+    for i, (turn, sent) in enumerate(zip(turns, payload)):
+        tokens = sum(_part_tokens(part) for part in sent["parts"])
+        if i == len(turns) - 1:
+            by_source["instruction"] += tokens
+            continue
+        by_source[turn.get("source", "history")] += tokens
+        by_origin[turn.get("statement") or "inputs"] += tokens
+
+    estimated = sum(by_source.values())
+    if reported_tokens and estimated:
+        scale = reported_tokens / estimated
+        by_source = {k: v * scale for k, v in by_source.items()}
+        by_origin = {k: v * scale for k, v in by_origin.items()}
+
+    _profiler.record(
+        CallProfile(
+            index=0,
+            statement=current_statement(),
+            prompt_tokens=reported_tokens or estimated,
+            reported=bool(reported_tokens),
+            by_source=dict(by_source),
+            by_origin=dict(by_origin),
+        )
+    )
+
+
+def _part_tokens(part: dict) -> float:
+    if "text" in part:
+        return _estimate(part["text"])
+    if "inline_data" in part:
+        # Base64 is a third bigger than the bytes it encodes
+        return len(part["inline_data"]["data"]) * 3 / 4 / CHARS_PER_TOKEN
+    return 0.0
+
+
+def _estimate(text: str) -> float:
+    return len(text) / CHARS_PER_TOKEN
+
+
+def _share(tokens: float, total: float) -> str:
+    return f"{100 * tokens / total:5.1f}%" if total else "    -"
+
+
+def _short(text: str, limit: int = 60) -> str:
+    text = " ".join(text.split())
+    return text if len(text) <= limit else text[: limit - 3] + "..."
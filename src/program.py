@@ -1,16 +1,31 @@
 from collections.abc import Sequence
+from typing import Literal
 
 from pydantic import BaseModel, model_validator
 
-from src.schemas import JsonSchema
+from src.schemas import LOCAL_OP_NAMES, JsonSchema
 from src.tools import Tool
 
 
+class LocalOp(BaseModel):
+    """
+    An operation which can run a command in-process, without the LLM.
+
+    `arg` is the operation's argument: the expression for "arithmetic", the
+    key or column for the sorts, and the date format for "date_prime_factors".
+    """
+
+    op: Literal[tuple(LOCAL_OP_NAMES)]
+    arg: str | None = None
+
+
 class Command(BaseModel):
     prompt: str
     tools: Sequence[Tool] = []
     files: list[str] = []
     response_schema: JsonSchema | None = None
+    # Tried before the LLM, if set
+    local: LocalOp | None = None
 
     def __str__(self) -> str:
         tools_str = (
@@ -19,7 +34,8 @@ class Command(BaseModel):
             else "none"
         )
         files_str = ", ".join(self.files) if self.files else "none"
-        return f"Command('{self.prompt}', tools=[{tools_str}], files=[{files_str}])"
+        local_str = f", local={self.local.op}" if self.local else ""
+        return f"Command('{self.prompt}', tools=[{tools_str}], files=[{files_str}]{local_str})"
 
     @model_validator(mode="after")
     def tools_or_schema(self):
@@ -29,9 +45,41 @@ class Command(BaseModel):
         return self
 
 
+class BranchPolicy(BaseModel):
+    """
+    What to do when a branch of a Map raises.
+
+    Failed branches are retried `retries` times (with jittered backoff), then
+    once more with `fallback_model` if it's set. If they still fail, they're
+    either raised, failing the run, or recorded as failed in the map's results.
+    """
+
+    retries: int = 0
+    fallback_model: str | None = None
+    on_failure: Literal["raise", "record"] = "raise"
+
+
+class FanoutLimit(BaseModel):
+    """
+    A cap on the number of items a Map processes.
+
+    If its dimension returns more than `max_items` items, the map either fails
+    before starting any branches, keeps the first `max_items` ("truncate"), or
+    keeps a sample of them. "random" samples uniformly; "stratified" splits the
+    list into `max_items` equal runs and picks one item at random from each, so
+    the whole list is covered.
+    """
+
+    max_items: int
+    overflow: Literal["fail", "truncate", "random", "stratified"] = "fail"
+
+
 class Map(BaseModel):
     dimension: Command
     body: "Program"
+    # These default to the policy and limit for the run
+    policy: BranchPolicy | None = None
+    limit: FanoutLimit | None = None
 
     def __str__(self) -> str:
         # Indent the body content properly
@@ -40,7 +88,31 @@ class Map(BaseModel):
         return s
 
 
-Statement = Map | Command
+class Fold(BaseModel):
+    """
+    A sequential loop which carries state from one item to the next.
+
+    Unlike a Map, items are processed in order. Each item runs in a fresh
+    fork of the conversation, which is given the `state` left by the item
+    before it as text, rather than the full results of earlier items. If
+    `stop_when` is set, the loop exits as soon as the condition holds.
+    """
+
+    dimension: Command
+    body: "Program"
+    state: str
+    stop_when: str | None = None
+
+    def __str__(self) -> str:
+        body_str = str(self.body).replace("\n", "\n  ")
+        s = f"Fold(\n  dimension: {self.dimension}\n  state: '{self.state}'"
+        if self.stop_when:
+            s += f"\n  stop_when: '{self.stop_when}'"
+        s += f"\n  body: {body_str})"
+        return s
+
+
+Statement = Map | Fold | Command
 
 
 class Program(BaseModel):
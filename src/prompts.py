@@ -6,7 +6,7 @@ You are an expert compiler and natural language processing specialist. You excel
 
 Your task is to compile a domain-specific language (DSL) called "vibe files" into an Abstract Syntax Tree (AST). These vibe files contain informal descriptions of data processing workflows that need to be converted into structured programs.
 
-The AST has three main statement types:
+The AST has four main statement types:
 
 1. **Map**: Represents iteration/loops over data (e.g., "for each item", "iterate over", "process all")
    - Contains a dimension command that defines what to iterate over
@@ -14,14 +14,20 @@ The AST has three main statement types:
    - Should ONLY contain lines that pertain to the data being looped over. If a line refers to ALL of the the data being looped over, the map has ended. Same if the statement initiates a loop over a different kind of data.
    - A new map can start while inside another map. For example, you might loop over a set of search results, and then loop over all the links on each page in the search results. An inner map will always refer to the dimension of the outer map, otherwise, the two should be separated by an "EndMap" (below).
 
-2. **EndMap**" Represents the end of the most recent ongoing "map" statement.
+2. **Fold**: Represents a loop which carries ongoing state from one item to the next (e.g. "go through each ... keeping a running total", "for each ..., until you find ...", "find the first ... which ...")
+   - Items are processed one at a time, in order. Each one sees only the ongoing state left by the ones before it, not their full results.
+   - Use a Fold instead of a Map only when the items depend on each other, or when the loop can stop early once something has been found. Otherwise, prefer a Map, which is processed in parallel.
+   - Describe the ongoing state in a few words (e.g. "the running total", "the best candidate so far").
+   - If the loop can stop early, describe the stopping condition (e.g. "a post with a typo has been found").
+
+3. **EndMap**" Represents the end of the most recent ongoing "map" or "fold" statement.
    - Any statement which no longer needs to be carried out *once per element* of the "map" statement
      should be considered the end of that map. This might include:
      - aggregation/combination operations (e.g., "combine results", "merge into", "aggregate", "sort by"),
      - statements which select a subset of the results (e.g. "pick the best", "choose a few of...")
      - new map statements which don't include a reference to the original statement.
 
-3. **Command**: Represents single actions (e.g., "extract data", "look up", "fetch", "scrape")
+4. **Command**: Represents single actions (e.g., "extract data", "look up", "fetch", "scrape")
    - Contains a prompt describing what to do
    - Contains a list of tools needed (like URL fetchers, APIs, etc.) and files to upload.
 
@@ -32,12 +38,12 @@ You are skilled at recognizing these patterns in natural language and converting
 def classification_prompt(line: str, current_map: str | None) -> str:
     if current_map:
         current_map_prompt = f"""
-- "EndMap" = the end of the most recent "Map". (Combine, merge, an unrelated command, or a new map which is not related to the elements of the first one. etc.)
-  The most recent "Map" instruction was: {current_map}
+- "EndMap" = the end of the most recent "Map" or "Fold". (Combine, merge, an unrelated command, or a new map which is not related to the elements of the first one. etc.)
+  The most recent "Map" or "Fold" instruction was: {current_map}
 """
     else:
         current_map_prompt = """
-There is currently no active "Map", so "EndMap" is not an option.
+There is currently no active "Map" or "Fold", so "EndMap" is not an option.
 """
 
     return f"""
@@ -47,7 +53,8 @@ Line: {line}
 
 Classification rules:
 - "Command" = single action (extract, look up, etc.)
-- "Map" = loops/iteration (for each, iterate over, etc.)
+- "Map" = loops/iteration (for each, iterate over, etc.) where each item is independent
+- "Fold" = loops which carry state between items, or which stop early once a condition is met
 {current_map_prompt}
 
 Tool options:
@@ -56,9 +63,19 @@ Tool options:
 - "read_file": for reading the contents of a file on the user's computer and attaching them to the conversation
 
 Return a JSON object with:
-- "type": the classification ("Map", "EndMap", or "Command")
+- "type": the classification ("Map", "Fold", "EndMap", or "Command")
 - "tools": array of names of any tool needed to execute this line of the program.
 - "files": array of filenames of any files which should be added to the conversation when executing this line.
+- "state": for a "Fold" only, a short description of the state carried from one item to the next.
+- "stop_when": for a "Fold" only, the condition under which the loop can stop early, if any.
+- "output": for a "Command" only, the shape of its result: "number", "boolean", "list" (of strings), "table" (rows of cells, e.g. for a CSV or a spreadsheet), or "text" for anything else, including prose. Only choose a structured shape when the line clearly asks for one.
+- "local_op": for a "Command" only, an operation which computes its result exactly without an LLM, or "none". Only choose one when the line is nothing but that computation:
+  - "arithmetic": plain arithmetic on numbers written in the line; "local_arg" is the expression in Python syntax, e.g. "(17 + 4) * 3"
+  - "sort" / "sort_descending": sort the previous results; "local_arg" is the field or column to sort by, if any
+  - "dedupe": remove duplicates from the previous results
+  - "csv": combine the previous results into a CSV
+  - "json": combine the previous results into JSON
+  - "date_prime_factors": the prime factors of today's date; "local_arg" is the date format as a Python strftime format, e.g. "%d%m%y" for DDMMYY
 
 
 A couple of notes about tools:
@@ -105,6 +122,13 @@ You excel at following procedural instructions and completing data processing ta
 """.strip()
 
 
+def inputs_prompt(inputs: dict) -> str:
+    values = "\n".join(f"{name}: {value}" for name, value in inputs.items())
+    return f"""The inputs for this run are:
+
+{values}"""
+
+
 def require_json_list_prompt(prompt: str) -> str:
     return f"""
 Please generate a JSON array of the items to process from the following instruction:
@@ -130,12 +154,71 @@ def map_context_prompt(item) -> str:
 {item}"""
 
 
+def fold_context_prompt(item, index: int, state: str, current_state: str) -> str:
+    prompt = f"""You're processing the items of the above list one at a time, in order. This is item {index + 1}. The current value is:
+
+{item}"""
+    if current_state:
+        prompt += f"""
+
+So far, {state} is:
+
+{current_state}"""
+    return prompt
+
+
+def fold_stop_prompt(stop_when: str) -> str:
+    return f"""Given everything so far, does the following condition hold?
+
+{stop_when}
+
+Return a JSON object with "stop": true if it does, or false if we should carry on with the next item."""
+
+
+def fold_results_prompt(
+    state: str, current_state: str, processed: int, total: int
+) -> str:
+    if processed < total:
+        progress = f"Stopped early after {processed} of {total} items."
+    else:
+        progress = f"Processed all {total} items."
+    return f"""{progress} After the previous instruction, {state} is:
+
+{current_state}
+"""
+
+
+def failed_branch_result(error: Exception) -> str:
+    return f"FAILED: this item couldn't be processed ({type(error).__name__}: {error})"
+
+
 def map_results_prompt(branch_results: list[tuple]) -> str:
     results_summary = "Here are the results of the previous instruction:\n"
     for item, result in branch_results:
         results_summary += f"{item}: {result}\n"
     return results_summary
 
+
+def reduce_results_prompt(
+    dimension: str, instructions: list[str], branch_results: list[tuple]
+) -> str:
+    steps = "\n".join(f"- {instruction}" for instruction in instructions)
+    results = "\n".join(f"{item}: {result}" for item, result in branch_results)
+    return f"""The following instructions were carried out once for each item of a list:
+
+{steps}
+
+The list came from this instruction:
+
+{dimension}
+
+Here are the results for a group of those items:
+
+{results}
+
+Combine these results into a single, concise summary. Keep every detail a later step could need (names, numbers, links, etc.), and make it clear which item each detail came from. Don't add anything which isn't in the results."""
+
+
 def text_file_prompt(filename: str, contents: str) -> str:
     return f"""The following are the full contents of the file {filename}:
 
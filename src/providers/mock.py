@@ -0,0 +1,118 @@
+"""
+A mock provider, for running programs without an API key or network.
+
+Set `LLM_PROVIDER=mock`. Responses are placeholders shaped by the request: JSON
+matching the response schema if there is one, a short list when asked for a
+list, and otherwise a line of text. Usage is reported like Gemini's, estimated
+from the size of the request, so telemetry and `cli.py profile` work as usual.
+
+Everything above the HTTP request (concurrency limits, hedging, retries,
+telemetry) is the real `LLM`, so `MOCK_LATENCY` can stand in for a slow model.
+"""
+
+import json
+import os
+import time
+
+import requests
+
+from src.llm import LLM
+
+# Items in mock lists
+MOCK_LIST_LENGTH = 3
+
+# Rough characters per token, for the usage reported with responses
+CHARS_PER_TOKEN = 4
+
+# Enum values chosen over the first one, so that compiling with the mock gives
+# plain commands rather than nesting every line in a map.
+PREFERRED_ENUM_VALUES = ("Command", "none", "text")
+
+
+class MockLLM(LLM):
+    def __init__(
+        self,
+        model: str = "mock",
+        max_concurrency: int = 8,
+        latency: float = 0.0,
+        min_concurrency: int = 1,
+        hedge_after: float | None = None,
+        hedge_percentile: float | None = None,
+    ):
+        super().__init__(
+            None,
+            "mock://",
+            model,
+            max_concurrency,
+            hedge_after=hedge_after,
+            hedge_percentile=hedge_percentile,
+            min_concurrency=min_concurrency,
+        )
+        self.latency = latency
+
+    @classmethod
+    def from_env(cls):
+        model = os.getenv("MOCK_MODEL", "mock")
+        hedge_after = os.getenv("LLM_HEDGE_AFTER")
+        hedge_percentile = os.getenv("LLM_HEDGE_PERCENTILE")
+        print(f"Using model {model} from provider mock")
+        return cls(
+            model,
+            int(os.getenv("LLM_MAX_CONCURRENCY", 8)),
+            float(os.getenv("MOCK_LATENCY", 0)),
+            int(os.getenv("LLM_MIN_CONCURRENCY", 1)),
+            hedge_after=float(hedge_after) if hedge_after else None,
+            hedge_percentile=float(hedge_percentile) if hedge_percentile else None,
+        )
+
+    def _send(self, model: str, payload: dict) -> requests.Response:
+        if self.latency:
+            time.sleep(self.latency)
+
+        schema = payload.get("generationConfig", {}).get("responseSchema")
+        if schema is not None:
+            text = json.dumps(_mock_value(schema))
+        elif "JSON array" in _last_text(payload):
+            text = json.dumps([f"item {i + 1}" for i in range(MOCK_LIST_LENGTH)])
+        else:
+            text = f"Mock response to: {_last_text(payload)[:80].strip()}"
+
+        body = {
+            "candidates": [{"content": {"parts": [{"text": text}], "role": "model"}}],
+            "usageMetadata": {
+                "promptTokenCount": len(json.dumps(payload)) // CHARS_PER_TOKEN,
+                "candidatesTokenCount": len(text) // CHARS_PER_TOKEN,
+            },
+        }
+        response = requests.Response()
+        response.status_code = 200
+        response._content = json.dumps(body).encode("utf-8")
+        return response
+
+
+def _last_text(payload: dict) -> str:
+    parts = payload["contents"][-1]["parts"]
+    return " ".join(part.get("text", "") for part in parts)
+
+
+def _mock_value(schema: dict, in_object: bool = False):
+    """A value matching `schema`, for the subset of JSON schema used here."""
+    if "enum" in schema:
+        preferred = [v for v in schema["enum"] if v in PREFERRED_ENUM_VALUES]
+        return (preferred or schema["enum"])[0]
+
+    kind = schema.get("type")
+    if kind == "object":
+        properties = schema.get("properties", {})
+        required = schema.get("required", list(properties))
+        return {name: _mock_value(properties[name], in_object=True) for name in required}
+    if kind == "array":
+        # Lists nested in objects (e.g. tools) are left empty
+        if in_object:
+            return []
+        return [_mock_value(schema.get("items", {})) for _ in range(MOCK_LIST_LENGTH)]
+    if kind == "number" or kind == "integer":
+        return 1
+    if kind == "boolean":
+        return False
+    return "mock"
@@ -0,0 +1,71 @@
+import os
+import sqlite3
+import tempfile
+import threading
+import uuid
+import weakref
+
+
+class ResultsStore:
+    """
+    Holds raw results off-conversation, keyed by ID.
+
+    Map branch results, file payloads and large conversation turns are written
+    to a SQLite file rather than kept in memory, so memory use doesn't grow with
+    the width or nesting of maps. Conversations keep only the IDs, and look the
+    values up again when building a request.
+
+    If no `path` is given, a temporary file is used and deleted when the store
+    is closed or garbage collected. Otherwise the results are kept in `path`
+    after the store is closed.
+    """
+
+    def __init__(self, path: str | None = None):
+        if path is None:
+            fd, path = tempfile.mkstemp(prefix="vibe-results-", suffix=".sqlite")
+            os.close(fd)
+            temporary = True
+        else:
+            temporary = False
+
+        self.path = path
+        self._lock = threading.Lock()
+        # Autocommit, so each result is written as soon as it's put
+        self._db = sqlite3.connect(
+            path, check_same_thread=False, isolation_level=None
+        )
+        self._db.execute("PRAGMA synchronous = OFF")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, value TEXT)"
+        )
+        self._finalizer = weakref.finalize(
+            self, _close, self._db, path if temporary else None
+        )
+
+    def put(self, value: str) -> str:
+        key = uuid.uuid4().hex
+        with self._lock:
+            self._db.execute("INSERT INTO results VALUES (?, ?)", (key, value))
+        return key
+
+    def get(self, key: str) -> str:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT value FROM results WHERE key = ?", (key,)
+            ).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return row[0]
+
+    def close(self):
+        self._finalizer()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+
+
+def _close(db: sqlite3.Connection, temporary_path: str | None):
+    db.close()
+    if temporary_path and os.path.exists(temporary_path):
+        os.remove(temporary_path)
@@ -1,82 +1,243 @@
 import json
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from copy import deepcopy
 
+from jsonschema import Draft7Validator
+from pydantic import BaseModel, PrivateAttr
 from tqdm import tqdm
 
+from src import profiler
 from src.llm import LLM, Conversation
-from src.program import Command, Map, Program
+from src.local import LocalOpError, execute_local, is_table, table_to_csv
+from src.program import BranchPolicy, Command, FanoutLimit, Fold, Map, Program
 from src.prompts import (
     RUNNER_SYSTEM_PROMPT,
+    failed_branch_result,
+    fold_context_prompt,
+    fold_results_prompt,
+    fold_stop_prompt,
+    inputs_prompt,
     map_context_prompt,
     map_results_prompt,
+    reduce_results_prompt,
     retry_json_list_prompt,
 )
-from src.schemas import GENERIC_LIST_SCHEMA
-
-
-def run_program(program: Program, llm: LLM | None = None) -> str:
+from src.schemas import GENERIC_LIST_SCHEMA, STOP_SCHEMA
+from src.trace import in_context, span
+
+# Map results are combined in groups of this size until at most this many remain.
+REDUCE_GROUP_SIZE = 20
+# Maximum number of groups reduced concurrently.
+REDUCE_PARALLELISM = 8
+# Base delay, in seconds, between retries of a failed map branch.
+BRANCH_RETRY_DELAY = 1.0
+
+
+class FanoutBudget:
+    """The number of map branches a run may still start, shared by nested maps."""
+
+    def __init__(self, max_branches: int | None):
+        self.remaining = max_branches
+        self._lock = threading.Lock()
+
+    def reserve(self, n: int) -> int:
+        """Reserve up to `n` branches, returning how many were granted."""
+        with self._lock:
+            if self.remaining is None:
+                return n
+            granted = min(n, self.remaining)
+            self.remaining -= granted
+            return granted
+
+    def release(self, n: int):
+        """Give back `n` reserved branches which won't be started."""
+        with self._lock:
+            if self.remaining is not None:
+                self.remaining += n
+
+
+class RunOptions(BaseModel):
+    """Settings for a run which aren't part of the program itself."""
+
+    # Used by maps which don't set their own policy
+    branch_policy: BranchPolicy = BranchPolicy()
+    # Maximum number of branches of each map run concurrently. By default,
+    # enough that the client's adaptive concurrency limit, shared by all maps,
+    # is what bounds the requests in flight.
+    map_parallelism: int | None = None
+    # Used by maps which don't set their own limit, and by folds
+    fanout_limit: FanoutLimit | None = None
+    # Run commands marked with a local operation in-process when possible
+    local_ops: bool = True
+    # Maximum number of map branches and fold items in the whole run, including
+    # nested ones. Loops which would exceed it are handled by their limit's
+    # overflow policy.
+    max_branches: int | None = None
+
+    # Set up by `run_program` for each run
+    _budget: FanoutBudget = PrivateAttr(default_factory=lambda: FanoutBudget(None))
+
+
+def run_program(
+    program: Program,
+    llm: LLM | None = None,
+    inputs: dict | None = None,
+    options: RunOptions | None = None,
+) -> str:
     """
     Execute a compiled vibe program.
 
     Args:
         program: The compiled Program to execute
         llm: Optional LLM instance (defaults to LLM.from_env())
+        inputs: Optional named values to give the program before it starts
+        options: Optional settings for the run (defaults to RunOptions())
 
     Returns:
         Final execution result as a string
     """
     if llm is None:
         llm = LLM.from_env()
+    if options is None:
+        options = RunOptions()
+    # Each run gets its own budget, even if it shares options with others
+    options = options.model_copy()
+    options._budget = FanoutBudget(options.max_branches)
 
     # Start with a fresh conversation using the runner system prompt
     conversation = llm.converse(RUNNER_SYSTEM_PROMPT)
+    if inputs:
+        conversation.append_message(inputs_prompt(inputs), "user")
 
-    return _execute_program(program, conversation)
+    with span("run", statements=len(program.statements)):
+        return _execute_program(program, conversation, options)
 
 
-def _copy_conversation(conv: Conversation) -> Conversation:
-    """Create a deep copy of a conversation with its history."""
-    new_conv = Conversation(conv.llm, conv.model, conv.system_prompt)
-    new_conv.conversation = deepcopy(conv.conversation)
+def _copy_conversation(conv: Conversation, model: str | None = None) -> Conversation:
+    """Create a deep copy of a conversation with its history, optionally switching model."""
+    new_conv = Conversation(
+        conv.llm, model or conv.model, conv.system_prompt, conv.store
+    )
+    with span("copy conversation", turns=len(conv.conversation)):
+        new_conv.conversation = deepcopy(conv.conversation)
     return new_conv
 
 
-def _execute_program(program: Program, conversation: Conversation) -> str:
+def _execute_program(
+    program: Program, conversation: Conversation, options: RunOptions
+) -> str:
     """Execute a program with the given conversation stack."""
     last_result = ""
+    # Statements are labelled by their position, e.g. "3.1" in the body of "3"
+    parent = profiler.current_statement()
 
-    for statement in program.statements:
+    for i, statement in enumerate(program.statements, start=1):
+        label = f"{parent}.{i}" if parent else str(i)
         if isinstance(statement, Command):
-            last_result = _execute_command(statement, conversation)
-        else:
-            last_result = _execute_map(statement, conversation)
+            with span("Command", prompt=statement.prompt), profiler.statement(
+                label, statement.prompt
+            ):
+                last_result = _execute_command(
+                    statement, conversation, options.local_ops
+                )
+            continue
+
+        prompt = statement.dimension.prompt
+        with profiler.statement(label, prompt):
+            if isinstance(statement, Fold):
+                with span("Fold", prompt=prompt):
+                    last_result = _execute_fold(statement, conversation, options)
+            else:
+                with span("Map", prompt=prompt):
+                    last_result = _execute_map(statement, conversation, options)
     return last_result
 
 
-def _execute_command(command: Command, conversation: Conversation) -> str:
-    """Execute a command statement."""
+def _execute_command(
+    command: Command, conversation: Conversation, local: bool = False
+) -> str:
+    """
+    Execute a command statement.
+
+    With `local`, commands marked with a local operation are run in-process,
+    falling back to the LLM if the operation can't handle its input. Commands
+    with tools or files always go to the LLM, which needs them.
+    """
+    runs_locally = (
+        local and command.local is not None and not command.tools and not command.files
+    )
+    if runs_locally:
+        result = _execute_local(command, conversation)
+        if result is not None:
+            return result
 
     for filename in command.files:
-        if filename.endswith('.pdf'):
-            conversation.append_binary_file(filename)
-        else:
-            conversation.append_text_file(filename)
+        with span("attach file", filename=filename):
+            if filename.endswith('.pdf'):
+                conversation.append_binary_file(filename)
+            else:
+                conversation.append_text_file(filename)
 
 
+    schema = command.response_schema.jsonschema if command.response_schema else None
     result = conversation.chat(
-        command.prompt, 
-        tools=command.tools
+        command.prompt,
+        tools=command.tools,
+        response_schema=schema,
     )
+
+    if schema is not None:
+        try:
+            value = _parse_structured(result, schema)
+        except ValueError:
+            # Keep the text; later statements can still read it
+            conversation.llm.telemetry.count("schema_mismatches")
+        else:
+            if is_table(value):
+                # Tables read better as CSV, in the conversation and the output
+                result = table_to_csv(value)
+                conversation.set_last_value(value, result)
+            else:
+                conversation.set_last_value(value)
+    return result
+
+
+def _parse_structured(response: str, schema: dict):
+    """Parse a structured response, raising ValueError if it doesn't match `schema`."""
+    value = json.loads(response)
+    error = next(Draft7Validator(schema).iter_errors(value), None)
+    if error is not None:
+        raise ValueError(f"Response doesn't match its schema: {error.message}")
+    return value
+
+
+def _execute_local(command: Command, conversation: Conversation) -> str | None:
+    """Run a command's local operation, or return None if it can't be used."""
+    telemetry = conversation.llm.telemetry
+    try:
+        with span("local op", op=command.local.op):
+            result, value = execute_local(command.local, conversation.last_value)
+    except LocalOpError as e:
+        print(f"Local {command.local.op} not possible, asking the LLM: {e}")
+        telemetry.count("local_op_fallbacks")
+        return None
+
+    telemetry.count("local_ops")
+    # Record it as if the LLM had answered, so later statements see it
+    conversation.append_message(command.prompt, "user")
+    conversation.append_message(result, "model")
+    conversation.set_last_value(value)
     return result
 
 
 def _parse_maybe_list(response: str) -> list | None:
     # Parse the JSON response
-    first_bracket, last_bracket = response.index("["), response.rindex("]")
+    first_bracket, last_bracket = response.find("["), response.rfind("]")
 
-    # TODO: if we can't just parse a list, call the LLM again with the list schema and the previous response,
-    # but not the tool.
-    if (first_bracket is None) or (last_bracket is None):
+    if first_bracket == -1 or last_bracket == -1:
         return None
 
     bracketed_part = response[first_bracket : last_bracket + 1]
@@ -91,47 +252,310 @@ def _parse_maybe_list(response: str) -> list | None:
 
 
 
-def _execute_map(map_stmt: Map, conversation: Conversation) -> str:
-    """
-    Execute a map statement with iteration over a list.
-
-    Adds a chat/response for the map statement and a summary of results.
-    """
+def _execute_dimension(dimension: Command, conversation: Conversation) -> list:
+    """Execute the dimension command of a map or fold and parse its list of items."""
 
     # Note: Gemini doesn't support function calls + json response format in the chat.
     # so we don't bother and delegate to `_execute_command`. Other providers might.
     # Gemini Pro might actually? TODO.
 
-    list_response = _execute_command(map_stmt.dimension, conversation)
+    with span("dimension", prompt=dimension.prompt):
+        list_response = _execute_command(dimension, conversation)
 
-    # TODO: if we can't just parse a list, call the LLM again with the list schema and the previous response,
-    # but not the tool.
-    items_list = _parse_maybe_list(list_response)
+    # If the dimension had a list schema, its items are already parsed.
+    # Otherwise if we can't just parse a list, call the LLM again with the list
+    # schema and the previous response, but not the tool.
+    items_list = conversation.last_value
+    if not isinstance(items_list, list):
+        items_list = _parse_maybe_list(list_response)
     if items_list is None:
-        items_list = conversation.chat(
-            retry_json_list_prompt(map_stmt.dimension.prompt, list_response),
+        retry_response = conversation.chat(
+            retry_json_list_prompt(dimension.prompt, list_response),
             response_schema=GENERIC_LIST_SCHEMA.jsonschema,
         )
-        if not isinstance(items_list, list):
-            raise RuntimeError(f"Didn't receive a list for {map_stmt}")
+        items_list = _parse_maybe_list(retry_response)
+        if items_list is None:
+            raise RuntimeError(f"Didn't receive a list for {dimension}")
 
-    # Process each item in the list
-    branch_results = []
-    for item in tqdm(items_list, desc="Processing map items", unit="item", ncols=0):
-        # Fork the conversation for this branch
-        branch_conversation = _copy_conversation(conversation)
+    conversation.llm.telemetry.observe("dimension_items", len(items_list))
+    return items_list
 
-        # Add the context message for this specific item
-        map_prompt = map_context_prompt(item)
-        branch_conversation.append_message(map_prompt, "user")
 
-        # Execute the map's body program with the forked conversation
-        branch_result = _execute_program(map_stmt.body, branch_conversation)
-        branch_results.append((item, branch_result))
+def _execute_branch(
+    map_stmt: Map,
+    item,
+    conversation: Conversation,
+    policy: BranchPolicy,
+    options: RunOptions,
+) -> tuple[str, object]:
+    """
+    Execute one branch of a map, applying its failure policy.
 
-    results_summary = map_results_prompt(branch_results)
+    Returns the ID of the branch's result in the results store, and the
+    structured value of the result if it has one.
+    """
+    models = [None] * (policy.retries + 1)
+    if policy.fallback_model:
+        models.append(policy.fallback_model)
+
+    for attempt, model in enumerate(models):
+        try:
+            with span("branch", item=item, attempt=attempt, model=model):
+                # Fork the conversation for this branch
+                branch_conversation = _copy_conversation(conversation, model)
+
+                # Add the context message for this specific item
+                map_prompt = map_context_prompt(item)
+                branch_conversation.append_message(
+                    map_prompt, "user", source="map_context"
+                )
+
+                # Execute the map's body program with the forked conversation
+                branch_result = _execute_program(
+                    map_stmt.body, branch_conversation, options
+                )
+                return (
+                    conversation.store.put(branch_result),
+                    branch_conversation.last_value,
+                )
+        except Exception as e:
+            error = e
+            if attempt < len(models) - 1:
+                delay = random.uniform(0, BRANCH_RETRY_DELAY * 2**attempt)
+                with span("branch retry delay", delay=delay):
+                    time.sleep(delay)
+
+    if policy.on_failure == "record":
+        print(f"Map item failed, continuing: {item!r}: {error}")
+        return conversation.store.put(failed_branch_result(error)), None
+    raise RuntimeError(f"Map item failed: {item!r}") from error
+
+
+def _execute_map(map_stmt: Map, conversation: Conversation, options: RunOptions) -> str:
+    """
+    Execute a map statement with iteration over a list.
+
+    Branches run concurrently, up to `options.map_parallelism` at a time, or
+    the client's maximum concurrency by default.
+
+    Adds a chat/response for the map statement and a summary of results.
+    """
+    items_list = _execute_dimension(map_stmt.dimension, conversation)
+    items_list = _limit_items(map_stmt, items_list, options, conversation.llm)
+    policy = map_stmt.policy or options.branch_policy
+
+    # Process each item in the list
+    parallelism = options.map_parallelism or conversation.llm.max_concurrency
+    with ThreadPoolExecutor(max_workers=parallelism) as executor:
+        futures = [
+            executor.submit(
+                in_context(_execute_branch),
+                map_stmt,
+                item,
+                conversation,
+                policy,
+                options,
+            )
+            for item in items_list
+        ]
+        try:
+            for future in tqdm(
+                as_completed(futures),
+                total=len(futures),
+                desc="Processing map items",
+                unit="item",
+                ncols=0,
+            ):
+                future.result()
+        except BaseException:
+            # Don't start any more branches once one has failed
+            executor.shutdown(cancel_futures=True)
+            raise
+
+    outcomes = [f.result() for f in futures]
+    branch_results = [(item, key) for item, (key, _) in zip(items_list, outcomes)]
+
+    with span("aggregate", branches=len(branch_results)):
+        results_summary = _aggregate_results(map_stmt, branch_results, conversation)
 
     # Add the combined results to the original conversation
-    conversation.append_message(results_summary, "user")
+    conversation.append_message(results_summary, "user", source="map_results")
+
+    # Keep the results as a value too, for local operations, but only if every
+    # branch gave structured output. Free text needs the LLM to make sense of.
+    if outcomes and all(value is not None for _, value in outcomes):
+        conversation.set_last_value(
+            [
+                {"item": item, "result": value}
+                for item, (_, value) in zip(items_list, outcomes)
+            ]
+        )
     return results_summary
 
+
+def _limit_items(
+    stmt: Map | Fold, items: list, options: RunOptions, llm: LLM
+) -> list:
+    """
+    Apply the loop's fan-out limit and the run's branch budget to its items,
+    before any branches start. Folds have no limit of their own, so they use
+    the run's.
+    """
+    kind = type(stmt).__name__
+    limit = getattr(stmt, "limit", None) or options.fanout_limit
+    overflow = limit.overflow if limit else "fail"
+
+    map_allowed = min(len(items), limit.max_items) if limit else len(items)
+    allowed = options._budget.reserve(map_allowed)
+    if allowed == len(items):
+        llm.telemetry.count("branches", allowed)
+        return items
+
+    if allowed < map_allowed:
+        reason = f"the run's remaining budget of {allowed} branches"
+    else:
+        reason = f"its limit of {allowed}"
+
+    if overflow == "fail":
+        # None of the branches will start, so later loops can have them
+        options._budget.release(allowed)
+        raise RuntimeError(
+            f"{kind} has {len(items)} items, over {reason}: {stmt.dimension.prompt}"
+        )
+
+    llm.telemetry.count("branches", allowed)
+    print(f"{kind} has {len(items)} items, over {reason}. Keeping {allowed} ({overflow}).")
+    llm.telemetry.count(f"fanout_{overflow}")
+    llm.telemetry.count("items_dropped", len(items) - allowed)
+    return _select_items(items, allowed, overflow)
+
+
+def _select_items(items: list, n: int, overflow: str) -> list:
+    """Pick `n` of `items`, keeping their order."""
+    if overflow == "truncate":
+        return items[:n]
+    if overflow == "random":
+        return [items[i] for i in sorted(random.sample(range(len(items)), n))]
+    if overflow == "stratified":
+        return [
+            items[random.randrange(i * len(items) // n, (i + 1) * len(items) // n)]
+            for i in range(n)
+        ]
+    raise ValueError(f"Unknown overflow policy: {overflow}")
+
+
+def _instructions(program: Program) -> list[str]:
+    """The top-level instructions of a program, for describing it in prompts."""
+    return [
+        stmt.prompt if isinstance(stmt, Command) else stmt.dimension.prompt
+        for stmt in program.statements
+    ]
+
+
+def _aggregate_results(
+    map_stmt: Map, branch_results: list[tuple], conversation: Conversation
+) -> str:
+    """
+    Aggregate a map's branch results into a single summary message.
+
+    `branch_results` are (item, result ID) pairs pointing into the results store,
+    and results are only loaded from the store one group at a time.
+    Small maps list every result as-is. Wider maps are tree-reduced: results are
+    combined in groups of `REDUCE_GROUP_SIZE` in parallel, then those combined
+    results are grouped again, until few enough remain to list. The reduce calls
+    run in fresh conversations, so the raw results never enter the parent
+    conversation.
+    """
+    store = conversation.store
+    results = branch_results
+
+    instructions = _instructions(map_stmt.body)
+
+    def reduce_group(group: list[tuple]) -> str:
+        with span("reduce group", size=len(group)):
+            # Only load one group of results into memory at a time
+            group = [(item, store.get(key)) for item, key in group]
+            reducer = conversation.llm.converse(
+                RUNNER_SYSTEM_PROMPT, conversation.model, store
+            )
+            summary = reducer.chat(
+                reduce_results_prompt(map_stmt.dimension.prompt, instructions, group)
+            )
+            return store.put(summary)
+
+    offset = 0
+    while len(results) > REDUCE_GROUP_SIZE:
+        groups = [
+            results[i : i + REDUCE_GROUP_SIZE]
+            for i in range(0, len(results), REDUCE_GROUP_SIZE)
+        ]
+        with ThreadPoolExecutor(max_workers=REDUCE_PARALLELISM) as executor:
+            summary_keys = list(
+                tqdm(
+                    executor.map(in_context(reduce_group), groups),
+                    total=len(groups),
+                    desc="Reducing map results",
+                    unit="group",
+                    ncols=0,
+                )
+            )
+        results = [
+            (f"Group {offset + i + 1}", key) for i, key in enumerate(summary_keys)
+        ]
+        offset += len(groups)
+
+    return map_results_prompt([(item, store.get(key)) for item, key in results])
+
+
+def _should_stop(stop_when: str, conversation: Conversation) -> bool:
+    """Ask whether a fold's early-exit condition holds, given its conversation."""
+    response = conversation.chat(
+        fold_stop_prompt(stop_when), response_schema=STOP_SCHEMA.jsonschema
+    )
+    try:
+        return bool(json.loads(response)["stop"])
+    except (json.JSONDecodeError, KeyError, TypeError):
+        return False
+
+
+def _execute_fold(fold: Fold, conversation: Conversation, options: RunOptions) -> str:
+    """
+    Execute a fold statement, processing items in order and carrying state.
+
+    Each item runs in a fresh fork of the conversation which sees the state
+    left by the item before it, so the context doesn't grow with the list.
+    If the fold has a `stop_when` condition, it's checked after each item and
+    the remaining items are skipped once it holds. Items count towards the
+    run's fan-out limit and branch budget, like map branches.
+
+    Adds a chat/response for the fold statement and a summary of the final state.
+    """
+    items_list = _execute_dimension(fold.dimension, conversation)
+    items_list = _limit_items(fold, items_list, options, conversation.llm)
+
+    current_state = ""
+    processed = 0
+    for index, item in enumerate(
+        tqdm(items_list, desc="Processing fold items", unit="item", ncols=0)
+    ):
+        with span("fold item", item=item, index=index):
+            item_conversation = _copy_conversation(conversation)
+            item_conversation.append_message(
+                fold_context_prompt(item, index, fold.state, current_state),
+                "user",
+                source="map_context",
+            )
+
+            current_state = _execute_program(fold.body, item_conversation, options)
+            processed += 1
+
+            if fold.stop_when:
+                with span("stop check", condition=fold.stop_when):
+                    if _should_stop(fold.stop_when, item_conversation):
+                        break
+
+    results_summary = fold_results_prompt(
+        fold.state, current_state, processed, len(items_list)
+    )
+    conversation.append_message(results_summary, "user", source="map_results")
+    return results_summary
@@ -40,6 +40,19 @@ STRING_LIST_SCHEMA = JsonSchema(
     }
 )
 
+STOP_SCHEMA = JsonSchema(
+    jsonschema={
+        "type": "object",
+        "properties": {
+            "stop": {
+                "type": "boolean",
+                "description": "Whether the stopping condition holds",
+            },
+        },
+        "required": ["stop"],
+    }
+)
+
 GENERIC_LIST_SCHEMA = JsonSchema(
     jsonschema={
         "type": "array",
@@ -48,7 +61,39 @@ GENERIC_LIST_SCHEMA = JsonSchema(
     }
 )
 
-ALL_COMMANDS = ["Map", "EndMap", "Command"]
+NUMBER_SCHEMA = JsonSchema(jsonschema={"type": "number"})
+
+BOOLEAN_SCHEMA = JsonSchema(jsonschema={"type": "boolean"})
+
+TABLE_SCHEMA = JsonSchema(
+    jsonschema={
+        "type": "array",
+        "items": {"type": "array", "items": {"type": "string"}},
+        "description": "Rows of a table, starting with a header row",
+    }
+)
+
+# Schemas for the kinds of output the compiler can choose for a command.
+# "text" has no schema.
+OUTPUT_SCHEMAS = {
+    "number": NUMBER_SCHEMA,
+    "boolean": BOOLEAN_SCHEMA,
+    "list": STRING_LIST_SCHEMA,
+    "table": TABLE_SCHEMA,
+}
+
+# Operations which can run in-process instead of by the LLM (see src/local.py)
+LOCAL_OP_NAMES = [
+    "arithmetic",
+    "sort",
+    "sort_descending",
+    "dedupe",
+    "csv",
+    "json",
+    "date_prime_factors",
+]
+
+ALL_COMMANDS = ["Map", "Fold", "EndMap", "Command"]
 
 
 def get_compile_schema(allowed_commands: list[str]) -> JsonSchema:
@@ -64,6 +109,28 @@ def get_compile_schema(allowed_commands: list[str]) -> JsonSchema:
                 },
                 "tools": TOOLS_SCHEMA.jsonschema,
                 "files": FILES_SCHEMA.jsonschema,
+                "state": {
+                    "type": "string",
+                    "description": "Fold only: the state carried from one item to the next",
+                },
+                "stop_when": {
+                    "type": "string",
+                    "description": "Fold only: a condition which ends the loop early once it holds",
+                },
+                "output": {
+                    "type": "string",
+                    "enum": ["text", *OUTPUT_SCHEMAS],
+                    "description": "Command only: the shape of the command's result",
+                },
+                "local_op": {
+                    "type": "string",
+                    "enum": ["none", *LOCAL_OP_NAMES],
+                    "description": "Command only: an operation which can compute the result without an LLM",
+                },
+                "local_arg": {
+                    "type": "string",
+                    "description": "Command only: the argument of the local operation, if it takes one",
+                },
             },
             "required": ["type", "tools"],
         }
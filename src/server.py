@@ -0,0 +1,99 @@
+"""
+A long-lived worker which compiles and runs vibe programs for `cli.py`.
+
+`cli.py serve` starts the worker on a Unix socket, and `cli.py ... --daemon`
+submits jobs to it, so each call skips the imports and connection setup.
+The worker is a `VibeRuntime`, so it keeps one LLM client (with its
+connection pool) and caches compiled programs by source hash.
+
+The protocol is one JSON object per line in each direction. A job is:
+  {"mode": "compile", "lines": [...], "pretty": false, "parallel": false}
+  {"mode": "run", "lines": [...], "parallel": false, "options": {...}}
+  {"mode": "run", "compiled": "<contents of a .vibec file>", "options": {...}}
+where "options" are the fields of `RunOptions`.
+and the reply is {"output": "..."} or {"error": "..."}.
+
+Relative paths in programs (e.g. files to upload) are resolved against the
+worker's working directory.
+
+Only the client half of this module is imported by `cli.py` on the submit
+path, so it must not import anything heavy at the top level.
+"""
+
+import json
+import os
+import socket
+
+DEFAULT_SOCKET = os.getenv(
+    "VIBE_SOCKET", os.path.join(os.getenv("LOG_DIR", ".data/"), "vibe.sock")
+)
+
+def submit(job: dict, socket_path: str | None = None) -> str:
+    """Send a job to a running worker and wait for its output."""
+    socket_path = socket_path or DEFAULT_SOCKET
+    if not os.path.exists(socket_path):
+        raise RuntimeError(
+            f"No vibe worker is listening on {socket_path}. Start one with `cli.py serve`."
+        )
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path)
+        with sock.makefile("rwb") as stream:
+            stream.write(json.dumps(job).encode("utf-8") + b"\n")
+            stream.flush()
+            reply = json.loads(stream.readline())
+
+    if "error" in reply:
+        raise RuntimeError(f"Vibe worker failed: {reply['error']}")
+    return reply["output"]
+
+
+def serve(socket_path: str | None = None):
+    """Run a worker on `socket_path` until interrupted."""
+    socket_path = socket_path or DEFAULT_SOCKET
+    import socketserver
+
+    from src.artifact import dump_program, source_hash
+    from src.run import RunOptions
+    from src.vibe import VibeRuntime
+
+    runtime = VibeRuntime()
+
+    def handle(job: dict) -> str:
+        if "compiled" in job:
+            program = runtime.load(job["compiled"])
+        else:
+            program = runtime.compile(job["lines"], job.get("parallel", False))
+
+        if job["mode"] == "compile":
+            if job.get("pretty"):
+                return str(program)
+            return dump_program(program, source_hash(job["lines"]))
+        elif job["mode"] == "run":
+            options = RunOptions.model_validate(job.get("options", {}))
+            # Each connection has its own thread, so run there
+            return runtime.run_sync(program, options=options)
+        raise ValueError(f"Unknown mode: {job['mode']}")
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            try:
+                reply = {"output": handle(json.loads(self.rfile.readline()))}
+            except Exception as e:
+                reply = {"error": f"{type(e).__name__}: {e}"}
+            self.wfile.write(json.dumps(reply).encode("utf-8") + b"\n")
+
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    os.makedirs(os.path.dirname(socket_path) or ".", exist_ok=True)
+
+    with socketserver.ThreadingUnixStreamServer(socket_path, Handler) as server:
+        os.chmod(socket_path, 0o600)
+        print(f"Vibe worker listening on {socket_path}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            os.remove(socket_path)
+            runtime.close()
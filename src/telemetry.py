@@ -0,0 +1,110 @@
+import json
+import os
+import threading
+import time
+from collections import Counter, defaultdict, deque
+
+# Latency percentiles aren't reported until a model has this many samples.
+MIN_LATENCY_SAMPLES = 20
+
+# Latencies kept per model for percentiles, so they follow recent load and
+# computing one doesn't get slower as a run goes on
+LATENCY_WINDOW = 500
+
+# Summaries of past runs, used by `cli.py estimate`
+STATS_FILE = os.path.join(os.getenv("LOG_DIR", ".data/"), "stats.jsonl")
+
+
+class Telemetry:
+    """
+    Counters, gauges and latencies for an LLM client.
+
+    Shared by every thread using the client, so all updates take a lock.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters: Counter[str] = Counter()
+        self.gauges: dict[str, float] = {}
+        # Recent latencies per model, and totals (calls, seconds, max) for the run
+        self.latencies: defaultdict[str, deque[float]] = defaultdict(
+            lambda: deque(maxlen=LATENCY_WINDOW)
+        )
+        self._latency_totals: defaultdict[str, list[float]] = defaultdict(_totals)
+        # Totals (count, sum, max) of other observed values, e.g. token counts
+        # and list lengths. Only totals are kept, so long-lived clients don't
+        # grow with every call.
+        self.samples: defaultdict[str, list[float]] = defaultdict(_totals)
+
+    def count(self, name: str, n: int = 1):
+        with self._lock:
+            self.counters[name] += n
+
+    def gauge(self, name: str, value: float):
+        with self._lock:
+            self.gauges[name] = value
+
+    def record_latency(self, model: str, seconds: float):
+        with self._lock:
+            self.latencies[model].append(seconds)
+            _add(self._latency_totals[model], seconds)
+
+    def observe(self, name: str, value: float):
+        with self._lock:
+            _add(self.samples[name], value)
+
+    def percentile(self, model: str, percentile: float) -> float | None:
+        """The given percentile of the model's recent latency, if there are enough samples."""
+        with self._lock:
+            samples = sorted(self.latencies[model])
+        if len(samples) < MIN_LATENCY_SAMPLES:
+            return None
+        index = min(len(samples) - 1, int(len(samples) * percentile / 100))
+        return samples[index]
+
+    def summary(self) -> dict:
+        with self._lock:
+            latencies = {
+                model: {
+                    "calls": calls,
+                    "mean_seconds": seconds / calls,
+                    "max_seconds": max_seconds,
+                }
+                for model, (calls, seconds, max_seconds) in self._latency_totals.items()
+                if calls
+            }
+            samples = {
+                name: {"count": count, "mean": total / count, "max": max_value}
+                for name, (count, total, max_value) in self.samples.items()
+                if count
+            }
+            return {
+                "counters": dict(self.counters),
+                "gauges": dict(self.gauges),
+                "latency": latencies,
+                "samples": samples,
+            }
+
+    def save(self, filename: str = STATS_FILE):
+        """Append a summary of this telemetry to a JSON lines file of past runs."""
+        os.makedirs(os.path.dirname(filename) or ".", exist_ok=True)
+        with open(filename, "a") as f:
+            f.write(json.dumps({"time": time.time(), **self.summary()}) + "\n")
+
+    def __str__(self) -> str:
+        summary = self.summary()
+        parts = [f"{name}={value}" for name, value in sorted(summary["counters"].items())]
+        parts += [f"{name}={value:g}" for name, value in sorted(summary["gauges"].items())]
+        for model, stats in summary["latency"].items():
+            parts.append(f"{model} mean={stats['mean_seconds']:.2f}s max={stats['max_seconds']:.2f}s")
+        return ", ".join(parts)
+
+
+def _totals() -> list[float]:
+    return [0, 0.0, float("-inf")]
+
+
+def _add(totals: list[float], value: float):
+    totals[0] += 1
+    totals[1] += value
+    totals[2] = max(totals[2], value)
@@ -0,0 +1,140 @@
+"""
+Span-based tracing of compiles and runs.
+
+Spans nest following the program: a run contains its statements, a map its
+dimension, branches and aggregation, and everything ends in LLM calls. Traces
+are written as Chrome trace events, which can be opened offline in
+chrome://tracing or https://ui.perfetto.dev. Each thread gets its own lane, so
+concurrent map branches show up side by side.
+
+Tracing is off unless `start_tracing` is called. Until then, `span` is a
+no-op.
+"""
+
+import contextvars
+import functools
+import itertools
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# Global tracer, if tracing is enabled
+_tracer: "Tracer | None" = None
+
+# The innermost open span in the current thread/task
+_current_span: contextvars.ContextVar[int | None] = contextvars.ContextVar(
+    "current_span", default=None
+)
+
+
+class Tracer:
+    def __init__(self):
+        self.events: list[dict] = []
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._start = time.perf_counter()
+        self._threads: set[int] = set()
+
+    def next_id(self) -> int:
+        return next(self._ids)
+
+    def now(self) -> float:
+        """Microseconds since tracing started."""
+        return (time.perf_counter() - self._start) * 1e6
+
+    def add(self, event: dict):
+        thread = threading.current_thread()
+        with self._lock:
+            if thread.ident not in self._threads:
+                self._threads.add(thread.ident)
+                self.events.append(
+                    {
+                        "name": "thread_name",
+                        "ph": "M",
+                        "pid": os.getpid(),
+                        "tid": thread.ident,
+                        "args": {"name": thread.name},
+                    }
+                )
+            self.events.append(event)
+
+    def export(self, filename: str):
+        with self._lock:
+            trace = {"traceEvents": list(self.events), "displayTimeUnit": "ms"}
+        with open(filename, "w") as f:
+            json.dump(trace, f)
+
+
+def start_tracing() -> Tracer:
+    """Enable tracing for the rest of this process."""
+    global _tracer
+    _tracer = Tracer()
+    return _tracer
+
+
+def write_trace(filename: str):
+    """Write the spans recorded so far as a Chrome trace-event JSON file."""
+    if _tracer is None:
+        raise RuntimeError("Tracing isn't enabled")
+    os.makedirs(os.path.dirname(filename) or ".", exist_ok=True)
+    _tracer.export(filename)
+
+
+@contextmanager
+def span(name: str, **args):
+    """Record the time spent in this block, as a child of the enclosing span."""
+    tracer = _tracer
+    if tracer is None:
+        yield
+        return
+
+    span_id = tracer.next_id()
+    parent_id = _current_span.get()
+    token = _current_span.set(span_id)
+    start = tracer.now()
+    try:
+        yield
+    finally:
+        end = tracer.now()
+        _current_span.reset(token)
+        tracer.add(
+            {
+                "name": name,
+                "ph": "X",
+                "ts": start,
+                "dur": end - start,
+                "pid": os.getpid(),
+                "tid": threading.get_ident(),
+                "args": {
+                    **{k: _short(v) for k, v in args.items()},
+                    "span_id": span_id,
+                    "parent_id": parent_id,
+                },
+            }
+        )
+
+
+def in_context(fn):
+    """
+    Wrap `fn` to run in a copy of the caller's context.
+
+    Threads in a ThreadPoolExecutor don't inherit the submitting thread's
+    context, so wrap functions with this before submitting them to keep
+    their spans under the current one.
+    """
+    context = contextvars.copy_context()
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        return context.copy().run(fn, *args, **kwargs)
+
+    return wrapper
+
+
+def _short(value, limit: int = 120) -> str | int | float | bool | None:
+    if value is None or isinstance(value, (int, float, bool)):
+        return value
+    text = str(value)
+    return text if len(text) <= limit else text[: limit - 3] + "..."
@@ -1,7 +1,41 @@
+"""
+Python API for building and running vibe programs from inside another process.
+
+`Vibe` builds a program statement by statement. `VibeRuntime` runs programs:
+it's meant to be created once, when a service starts, and shared by all its
+requests, so each run skips the startup cost of a new LLM client.
+
+Usage:
+
+    runtime = VibeRuntime()
+    program = runtime.compile(["for each planet:", "  name its largest moon"])
+    answers = await asyncio.gather(
+        runtime.run(program),
+        runtime.run(["summarize the topic"], inputs={"topic": "owls"}),
+    )
+    runtime.close()
+"""
+
+import asyncio
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from src.artifact import load_program, source_hash
+from src.compile import compile
+from src.llm import LLM
 from src.program import Command, Map, Program
 from src.prompts import require_json_list_prompt
+from src.run import RunOptions, run_program
 from src.schemas import GENERIC_LIST_SCHEMA, JsonSchema
-from tools import Tool
+from src.tools import Tool
+from src.trace import in_context, span
+
+# Programs run at once by a runtime; any more wait for a free thread
+DEFAULT_MAX_RUNS = 16
+
+# Compiled programs kept by a runtime, by source or artifact hash
+MAX_CACHED_PROGRAMS = 128
 
 
 class Vibe:
@@ -12,23 +46,26 @@ class Vibe:
     run, serialized, etc.
     """
 
-    def __init__(self, program: Program | None):
+    def __init__(self, program: Program | None = None):
         self.program: Program = program or Program()
 
     def append(self, node: Command | Map):
-        if self.program.statements[-1].node_type == "Map":
-            self.program.statements[-1].body.statements.append(node)
-        else:
-            self.program.statements.append(node)
+        self.program.statements.append(node)
 
-    def cmd(self, prompt: str, tools: list[Tool] | None, files: list[str] | None, schema: JsonSchema | dict | None = None):
+    def cmd(
+        self,
+        prompt: str,
+        tools: list[Tool] | None = None,
+        files: list[str] | None = None,
+        schema: JsonSchema | dict | None = None,
+    ):
         if isinstance(schema, dict):
-            schema = JsonSchema(schema=schema)
+            schema = JsonSchema(jsonschema=schema)
         cmd = Command(prompt=prompt, tools=tools or [], files=files or [], response_schema=schema)
         self.append(cmd)
         return self
 
-    def map(self, prompt: str, tools: list[Tool] | None, files: list[str] | None):
+    def map(self, prompt: str, tools: list[Tool] | None = None, files: list[str] | None = None):
         """
         Add a Map statement to the program, returning a new instance of this
         class to construct the body.
@@ -66,3 +103,108 @@ class Vibe:
         self.append(m)
         return Vibe(m.body)
 
+
+class VibeRuntime:
+    """
+    A long-lived runtime which compiles and runs vibe programs.
+
+    It owns one LLM client, whose connection pool and concurrency limit are
+    shared by every run, and a cache of compiled programs. Runs execute on a
+    pool of `max_runs` threads, so many can be awaited concurrently from one
+    event loop.
+    """
+
+    def __init__(
+        self,
+        llm: LLM | None = None,
+        options: RunOptions | None = None,
+        max_runs: int = DEFAULT_MAX_RUNS,
+    ):
+        # Only close the client if we created it
+        self._owns_llm = llm is None
+        self.llm = llm or LLM.from_env()
+        self.options = options or RunOptions()
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_runs, thread_name_prefix="vibe-run"
+        )
+        self._programs: OrderedDict[str, Program] = OrderedDict()
+        self._programs_lock = threading.Lock()
+
+    def compile(self, lines: list[str], parallel: bool = False) -> Program:
+        """Compile a vibe program, or get it from the cache if already compiled."""
+        return self._cached(
+            "vibe:" + source_hash(lines), lambda: compile(lines, self.llm, parallel)
+        )
+
+    def load(self, content: str) -> Program:
+        """Load the contents of a .vibec file, or get it from the cache."""
+        return self._cached(
+            "vibec:" + source_hash([content]), lambda: load_program(content)
+        )
+
+    def run_sync(
+        self,
+        program: Program | Vibe | list[str],
+        inputs: dict | None = None,
+        options: RunOptions | None = None,
+    ) -> str:
+        """
+        Run a program in the calling thread and return its result.
+
+        `program` may be compiled, built with `Vibe`, or the lines of its source.
+        """
+        if isinstance(program, Vibe):
+            program = program.program
+        elif not isinstance(program, Program):
+            program = self.compile(program)
+        return run_program(program, self.llm, inputs, options or self.options)
+
+    async def run(
+        self,
+        program: Program | Vibe | list[str],
+        inputs: dict | None = None,
+        options: RunOptions | None = None,
+    ) -> str:
+        """Run a program on the runtime's threads, without blocking the event loop."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._executor, in_context(self._run_traced), program, inputs, options
+        )
+
+    def close(self):
+        """Wait for running programs, then release the runtime's threads and client."""
+        self._executor.shutdown()
+        if self._owns_llm:
+            self.llm.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        # Shutting down waits for runs, so don't block the event loop on it
+        await asyncio.get_running_loop().run_in_executor(None, self.close)
+
+    def _run_traced(self, program, inputs, options) -> str:
+        with span("runtime run"):
+            return self.run_sync(program, inputs, options)
+
+    def _cached(self, key: str, build) -> Program:
+        with self._programs_lock:
+            if key in self._programs:
+                self._programs.move_to_end(key)
+                return self._programs[key]
+
+        # Built outside the lock, so other runs aren't held up by a compile
+        program = build()
+
+        with self._programs_lock:
+            self._programs[key] = program
+            if len(self._programs) > MAX_CACHED_PROGRAMS:
+                self._programs.popitem(last=False)
+        return program